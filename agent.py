@@ -1,44 +1,679 @@
-!/usr/bin/env python3
+#!/usr/bin/env python3
 """
 Agent module for Telegram Agent Bot
 Handles LLM integration and response generation using OpenAI GPT-3.5-turbo
 """
 
 import os
+import re
+import math
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+import sqlite3
+import threading
+from pathlib import Path
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Optional, Tuple, FrozenSet, Final, AsyncIterator
+import time
+import random
 import asyncio
+from functools import lru_cache
+from itertools import islice
 
 try:
-    import openai
+    from openai import (
+        AsyncOpenAI,
+        RateLimitError,
+        APIConnectionError,
+        InternalServerError,
+        APIStatusError
+    )
 except ImportError as e:
-    logging.error(f"OpenAI package not installed: {e}")
+    logging.error("OpenAI package not installed: %s", e)
     raise
 
+import httpx
+
+# HTTP/2 support for httpx (optional)
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Fast JSON serialization of request bodies (optional)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Exact token counting (optional)
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 logger = logging.getLogger(__name__)
 
+# Semantic response cache settings
+SEMANTIC_CACHE_THRESHOLD = 0.85  # Minimum cosine similarity for a cache hit
+SEMANTIC_CACHE_SIZE = 1024  # Max cached responses per cache key
+EXACT_CACHE_SIZE = 2048  # Max cached responses for exact message repeats
+INTENT_CACHE_SIZE = 256  # Max cached intent labels per triage model, kept apart from answers
+CACHE_MAX_TEMPERATURE = 0.3  # Sampling above this is too random to reuse answers
+
+# Persistent response cache settings (seconds)
+DISK_CACHE_TTL = 24 * 60 * 60
+DISK_CACHE_VOLATILE_TTL = 10 * 60  # Answers about weather, rates, news go stale fast
+
+# Cheap model for intent triage and context summaries
+DEFAULT_TRIAGE_MODEL = "gpt-4o-mini"  # Overridden by OPENAI_TRIAGE_MODEL
+DEFAULT_OPENAI_TEMPERATURE = 0.7  # Overridden by OPENAI_TEMPERATURE; answers are cached only at <= CACHE_MAX_TEMPERATURE
+TRIAGE_MAX_TOKENS = 64
+_INTENT_PROMPT: Final[str] = (
+    "Classify the intent of the user's message for a personal assistant bot. "
+    "Answer with exactly one word: CALENDAR (create events or reminders), "
+    "EMAIL (send an email), SEARCH (look something up on the web), "
+    "CHAT (conversation or a question the assistant can answer itself) or OTHER."
+)
+_INTENT_CACHE_KEY: Final[Tuple] = ('intent', hashlib.sha256(_INTENT_PROMPT.encode('utf-8')).hexdigest()[:12])
+_INTENTS: Final[FrozenSet[str]] = frozenset({'CALENDAR', 'EMAIL', 'SEARCH', 'CHAT', 'OTHER'})
+
+# Context compression settings
+CONTEXT_WINDOW = 4  # Raw history window sent alongside the rolling summary
+SUMMARY_MAX_TOKENS = 150
+SUMMARY_CACHE_USERS = 10000  # Users whose rolling summary is kept in memory
+CONTEXT_TOKEN_BUDGET = 2000  # Max prompt tokens spent on raw history
+PROMPT_TOKEN_RESERVE = 64  # Per-message formatting overhead and safety margin
+
+# Context window sizes of known models, in tokens
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# Conversation roles forwarded to the LLM from stored history
+_VALID_ROLES: Final[FrozenSet[str]] = frozenset({'user', 'assistant'})
+
+# Words that flip the meaning of an otherwise similar message, for the semantic cache
+_NEGATION_WORDS: Final[FrozenSet[str]] = frozenset({
+    'не', 'ни', 'нет', 'без', 'нельзя', 'никогда', 'ничего',
+    'not', 'no', 'never', 'without', 'nothing', 'nor',
+})
+_CONTRACTED_NOT_RE: Final = re.compile(r"n['’]t\b")
+
+# Max concurrent OpenAI requests, kept well below the account rate limit
+DEFAULT_OPENAI_CONCURRENCY = 50  # Overridden by OPENAI_CONCURRENCY
+
+# Request rate limit and retry policy for transient OpenAI errors
+DEFAULT_OPENAI_RPM = 500  # Overridden by OPENAI_RPM
+OPENAI_MAX_RETRIES = 5
+RETRY_INITIAL_DELAY = 0.5  # Seconds, doubled on every attempt
+RETRY_MAX_DELAY = 8.0
+# APITimeoutError is a subclass of APIConnectionError
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# Shared HTTP connection pool for OpenAI requests; idle connections are kept
+# long enough to survive gaps between chat turns without a new TLS handshake
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0)
+HTTP_TIMEOUT = httpx.Timeout(connect=3.0, read=30.0, write=10.0, pool=3.0)
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+class OrjsonAsyncClient(httpx.AsyncClient):
+    """
+    httpx client that serializes JSON request bodies with orjson
+    
+    httpx encodes json= bodies with the stdlib json module and ensure_ascii,
+    which escapes every Cyrillic character as \\uXXXX; orjson emits raw UTF-8,
+    several times faster and about half the size for Russian chats.
+    """
+    
+    def build_request(self, method, url, *, json: Any = None, content: Any = None, headers: Any = None, **kwargs):
+        if json is not None and content is None and orjson is not None:
+            content = orjson.dumps(json, option=orjson.OPT_NON_STR_KEYS)
+            headers = httpx.Headers(headers)
+            headers['Content-Type'] = 'application/json'
+            json = None
+        return super().build_request(method, url, json=json, content=content, headers=headers, **kwargs)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get process-wide HTTP client for OpenAI requests
+    
+    Keeps TCP/TLS connections alive between requests; with HTTP/2 available
+    concurrent chats are multiplexed over a single connection.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = OrjsonAsyncClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client, if it was created"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+
+# Static system prompt. It must stay byte-identical between requests and always
+# be the first message so the provider can reuse its cached prompt prefix;
+# anything dynamic (summary, knowledge) goes into later messages.
+_SYSTEM_PROMPT: Final[str] = """Ты - интеллектуальный личный помощник для Telegram. 
+
+Твои возможности:
+- Управление календарем через Google Calendar
+- Отправка email-уведомлений через Gmail  
+- Поиск информации в интернете
+- Запоминание контекста разговоров
+- Семантический поиск в базе знаний
+
+Инструкции:
+1. Отвечай на русском языке
+2. Будь дружелюбным и полезным
+3. Используй предоставленные знания для более точных ответов
+4. Если пользователь просит создать событие, напомнить или отправить email - предложи соответствующие команды
+5. Если нужно найти информацию - используй поиск
+6. Помни контекст разговора и ссылайся на предыдущие сообщения
+
+Команды MCP:
+- /calendar "добавить событие дата название" - для создания событий
+- /email "отправить email@example.com: тема" - для отправки email
+- /search "запрос" - для поиска информации
+
+Отвечай кратко, но информативно."""
+_SYSTEM_PROMPT_HASH: Final[str] = hashlib.sha256(_SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+# Keyword buckets for routing messages; matched as substrings of the lowercased message
+_KEYWORD_BUCKETS: Dict[str, FrozenSet[str]] = {
+    # MCP help topics
+    'mcp_calendar': frozenset({'календарь', 'calendar', 'событие', 'встреча', 'напоминание'}),
+    'mcp_email': frozenset({'email', 'почта', 'письмо', 'отправить', 'уведомление'}),
+    'mcp_search': frozenset({'поиск', 'search', 'найти', 'информация', 'погода', 'курс'}),
+    # Tool names: a message naming the tool is a command and skips triage; other MCP
+    # keywords ("найти", "курс", "встреча") also occur in ordinary questions
+    'mcp_command': frozenset({'календарь', 'calendar', 'email', 'почта', 'письмо', 'поиск', 'search'}),
+    # Fallback replies when LLM is disabled
+    'greeting': frozenset({'привет', 'hello', 'hi', 'здравствуй'}),
+    'thanks': frozenset({'спасибо', 'thanks', 'thank you'}),
+    'calendar': frozenset({'календарь', 'calendar', 'событие'}),
+    'email': frozenset({'email', 'почта', 'письмо'}),
+    'search': frozenset({'поиск', 'search', 'найти'}),
+}
+_MCP_LABELS: Final[FrozenSet[str]] = frozenset({'mcp_calendar', 'mcp_email', 'mcp_search'})
+_ALL_KEYWORDS: Final[FrozenSet[str]] = frozenset().union(*_KEYWORD_BUCKETS.values())
+
+# Static MCP help replies
+_MCP_CALENDAR_HELP: Final[str] = (
+    "Я могу помочь с управлением календарем! 📅\n\n"
+    "Используй команду:\n"
+    "/calendar \"добавить событие дата название\"\n\n"
+    "Примеры:\n"
+    "• /calendar \"добавить событие 10.10.2025 встреча с клиентом\"\n"
+    "• /calendar \"добавить событие завтра совещание\"\n"
+    "• /calendar \"добавить событие сегодня звонок\"\n\n"
+    "Поддерживаемые форматы дат: DD.MM.YYYY, \"сегодня\", \"завтра\""
+)
+_MCP_EMAIL_HELP: Final[str] = (
+    "Я могу отправлять email-уведомления! 📧\n\n"
+    "Используй команду:\n"
+    "/email \"отправить email@example.com: тема письма\"\n\n"
+    "Примеры:\n"
+    "• /email \"отправить reminder@example.com: встреча завтра\"\n"
+    "• /email \"отправить boss@company.com: отчет готов\"\n"
+    "• /email \"отправить friend@gmail.com: как дела?\"\n\n"
+    "Я автоматически добавлю информацию о времени отправки."
+)
+_MCP_SEARCH_HELP: Final[str] = (
+    "Я могу искать информацию в интернете! 🔍\n\n"
+    "Используй команду:\n"
+    "/search \"запрос для поиска\"\n\n"
+    "Примеры:\n"
+    "• /search \"погода в Москве\"\n"
+    "• /search \"курс доллара\"\n"
+    "• /search \"новости технологий\"\n"
+    "• /search \"рецепт борща\"\n\n"
+    "Я найду актуальную информацию и покажу результаты."
+)
+_MCP_GENERAL_HELP: Final[str] = (
+    "Я могу помочь с различными задачами! 🤖\n\n"
+    "Доступные команды:\n"
+    "📅 /calendar - управление календарем\n"
+    "📧 /email - отправка уведомлений\n"
+    "🔍 /search - поиск информации\n\n"
+    "Или просто напиши мне что-нибудь - я запоминаю наш разговор и могу помочь!"
+)
+
+
+# Static fallback replies when LLM is disabled
+_FALLBACK_DEFAULT: Final[str] = (
+    "Понял! Я запоминаю наш разговор и готов помочь.\n\n"
+    "Можешь использовать команды:\n"
+    "• /calendar - для событий\n"
+    "• /email - для уведомлений\n"
+    "• /search - для поиска\n"
+    "• /help - для справки"
+)
+
+# Reply tables in priority order: the first bucket found in the message wins
+_MCP_REPLIES: Final[Tuple[Tuple[str, str], ...]] = (
+    ('mcp_calendar', _MCP_CALENDAR_HELP),
+    ('mcp_email', _MCP_EMAIL_HELP),
+    ('mcp_search', _MCP_SEARCH_HELP),
+)
+_INTENT_REPLIES: Final[Dict[str, str]] = {
+    'CALENDAR': _MCP_CALENDAR_HELP,
+    'EMAIL': _MCP_EMAIL_HELP,
+    'SEARCH': _MCP_SEARCH_HELP,
+}
+_FALLBACK_REPLIES: Final[Tuple[Tuple[str, str], ...]] = (
+    ('greeting', "Привет! Рад тебя видеть! Как дела? Чем могу помочь?"),
+    ('thanks', "Пожалуйста! Всегда рад помочь! 😊"),
+    ('calendar', "Я могу помочь с календарем! Используй команду:\n/calendar \"добавить событие дата название\""),
+    ('email', "Я могу отправлять email! Используй команду:\n/email \"отправить email@example.com: тема\""),
+    ('search', "Я могу искать информацию! Используй команду:\n/search \"запрос для поиска\""),
+)
+
+def _build_keyword_matcher() -> Tuple[re.Pattern, Dict[str, FrozenSet[str]]]:
+    """
+    Compile all bucket keywords into one pattern scanned in a single pass.
+    
+    The alternation sits in a lookahead so a match is tried at every position,
+    longest keyword first; each keyword also carries the labels of keywords that
+    are its prefixes, so shorter keywords hidden by a longer match are not lost.
+    """
+    keyword_labels = {
+        keyword: frozenset(
+            label for label, keywords in _KEYWORD_BUCKETS.items()
+            if any(keyword.startswith(other) for other in keywords)
+        )
+        for keyword in _ALL_KEYWORDS
+    }
+    alternation = "|".join(re.escape(keyword) for keyword in sorted(_ALL_KEYWORDS, key=lambda k: (-len(k), k)))
+    return re.compile(f"(?=({alternation}))"), keyword_labels
+
+
+_KEYWORD_RE, _KEYWORD_LABELS = _build_keyword_matcher()
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """Get tiktoken encoding for model, or None if tiktoken is unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str, model: str) -> int:
+    """
+    Count tokens in text for model
+    
+    Cached per text, so history messages are tokenized once across turns.
+    Without tiktoken falls back to a conservative estimate of 2 characters
+    per token (Cyrillic text averages 2-3).
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 2 + 1
+    return len(encoding.encode(text))
+
+
+def _normalize_message(message: str) -> str:
+    """
+    Normalize user message for keyword routing and cache lookups
+    
+    Done once per request; all helpers below expect normalized text.
+    casefold() is the Unicode-correct caseless form and matches lower()
+    for Russian and English.
+    """
+    return message.strip().casefold()
+
+
+@lru_cache(maxsize=256)
+def _match_keywords(message_norm: str) -> FrozenSet[str]:
+    """Return labels of all keyword buckets found in normalized message"""
+    found = set(_KEYWORD_RE.findall(message_norm))
+    return frozenset().union(*(_KEYWORD_LABELS[keyword] for keyword in found))
+
+
+def _route_reply(message_norm: str, replies: Tuple[Tuple[str, str], ...], default: str) -> str:
+    """Return reply of the first bucket matched in normalized message, or default"""
+    labels = _match_keywords(message_norm)
+    for label, reply in replies:
+        if label in labels:
+            return reply
+    return default
+
+
+class AsyncRateLimiter:
+    """Sliding-window limiter allowing max_rate acquisitions per time_period seconds"""
+    
+    def __init__(self, max_rate: int, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._timestamps: deque = deque()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a request slot is free within the current window"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.time_period:
+                    self._timestamps.popleft()
+                
+                if len(self._timestamps) < self.max_rate:
+                    self._timestamps.append(now)
+                    return
+                
+                await asyncio.sleep(self.time_period - (now - self._timestamps[0]))
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class SemanticCache:
+    """
+    Lightweight semantic cache of LLM responses.
+
+    Messages are compared as bags of words (cosine similarity over token sets),
+    in line with the text search used by the knowledge base, so paraphrased
+    repeats ("погода в Москве" / "какая погода в москве") reuse one answer
+    without an embedding model. Bags of words do not see negations or numbers,
+    so a fuzzy hit also requires the same ones in both messages. Exact repeats ("привет") are answered from a
+    plain LRU dict before any similarity scan.
+    
+    An inverted index (word -> cached messages containing it) limits scoring
+    to entries sharing at least one word with the query, since all others
+    have zero similarity; lookups stay cheap as the cache fills up.
+    """
+    
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_size: int = SEMANTIC_CACHE_SIZE,
+        exact_max_size: int = EXACT_CACHE_SIZE
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.exact_max_size = exact_max_size
+        self._entries: Dict[Tuple, "OrderedDict[FrozenSet[str], str]"] = {}
+        self._postings: Dict[Tuple, Dict[str, set]] = {}
+        self._exact: "OrderedDict[Tuple, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _tokenize(message_norm: str) -> FrozenSet[str]:
+        """Split normalized message into a set of words"""
+        return frozenset(re.findall(r'\w+', _CONTRACTED_NOT_RE.sub(' not', message_norm)))
+    
+    @staticmethod
+    def _meaning_tokens(tokens: FrozenSet[str]) -> FrozenSet[str]:
+        """Negations and numbers: one differing word among them changes the answer"""
+        return frozenset(token for token in tokens if token in _NEGATION_WORDS or token.isdigit())
+    
+    def get(self, key: Tuple, message_norm: str) -> Optional[str]:
+        """Return cached response for the most similar normalized message, if similar enough"""
+        exact_key = (key, message_norm)
+        if exact_key in self._exact:
+            self.hits += 1
+            self._exact.move_to_end(exact_key)
+            return self._exact[exact_key]
+        
+        tokens = self._tokenize(message_norm)
+        entries = self._entries.get(key)
+        if not tokens or not entries:
+            self.misses += 1
+            return None
+        
+        # Count shared words per candidate from the inverted index
+        postings = self._postings[key]
+        overlaps: Dict[FrozenSet[str], int] = {}
+        for token in tokens:
+            for cached_tokens in postings.get(token, ()):
+                overlaps[cached_tokens] = overlaps.get(cached_tokens, 0) + 1
+        
+        # "я не люблю кошек" shares most words with "я люблю кошек", but is not a paraphrase
+        meaning = self._meaning_tokens(tokens)
+        best_tokens, best_score = None, 0.0
+        for cached_tokens, overlap in overlaps.items():
+            if self._meaning_tokens(cached_tokens) != meaning:
+                continue
+            score = overlap / math.sqrt(len(tokens) * len(cached_tokens))
+            if score > best_score:
+                best_tokens, best_score = cached_tokens, score
+        
+        if best_score < self.threshold:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        entries.move_to_end(best_tokens)
+        return entries[best_tokens]
+    
+    def put(self, key: Tuple, message_norm: str, response: str):
+        """Store response for normalized message under key, evicting the least recently used entry"""
+        exact_key = (key, message_norm)
+        self._exact[exact_key] = response
+        self._exact.move_to_end(exact_key)
+        if len(self._exact) > self.exact_max_size:
+            self._exact.popitem(last=False)
+        
+        tokens = self._tokenize(message_norm)
+        if not tokens:
+            return
+        
+        entries = self._entries.setdefault(key, OrderedDict())
+        postings = self._postings.setdefault(key, {})
+        if tokens not in entries:
+            for token in tokens:
+                postings.setdefault(token, set()).add(tokens)
+        entries[tokens] = response
+        entries.move_to_end(tokens)
+        
+        if len(entries) > self.max_size:
+            evicted, _ = entries.popitem(last=False)
+            for token in evicted:
+                postings[token].discard(evicted)
+                if not postings[token]:
+                    del postings[token]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        return {
+            'size': sum(len(entries) for entries in self._entries.values()),
+            'exact_size': len(self._exact),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class DiskResponseCache:
+    """
+    Persistent SQLite cache of LLM responses
+    
+    Second cache level behind SemanticCache: survives restarts and is shared
+    between bot processes using the same data directory.
+    """
+    
+    def __init__(self, db_path: str = "llm_cache.db"):
+        # Создаем директорию для данных если её нет
+        data_dir = Path("/app/data") if Path("/app").exists() else Path("data")
+        data_dir.mkdir(exist_ok=True)
+        
+        self.db_path = data_dir / db_path
+        self._db_str = str(self.db_path)
+        
+        # One connection for the process; calls come from asyncio.to_thread
+        # workers, so it is shared across threads behind a lock
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._init_database()
+    
+    def _init_database(self):
+        """Open the persistent connection, create the responses table and drop expired rows"""
+        try:
+            # isolation_level=None: every statement commits on its own
+            conn = sqlite3.connect(self._db_str, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            self._conn = conn
+        except sqlite3.Error as e:
+            logger.error("LLM cache database initialization error: %s", e)
+    
+    @staticmethod
+    def make_key(cache_key: Tuple, message_norm: str) -> str:
+        """Build stable key from cache key and normalized message"""
+        return hashlib.blake2b(repr((cache_key, message_norm)).encode('utf-8'), digest_size=16).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return cached response if present and not expired (blocking, call via asyncio.to_thread)"""
+        try:
+            with self._lock:
+                if self._conn is None:
+                    return None
+                row = self._conn.execute(
+                    "SELECT response FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, time.time())
+                ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            # Concurrent writers may briefly lock the database, treat as a miss
+            logger.warning("LLM cache read error: %s", e)
+            return None
+    
+    def put(self, key: str, response: str, model: str, ttl: float = DISK_CACHE_TTL):
+        """Store response for ttl seconds (blocking, call via asyncio.to_thread)"""
+        now = time.time()
+        try:
+            with self._lock:
+                if self._conn is None:
+                    return
+                self._conn.execute(
+                    "INSERT INTO responses (key, response, model, created_at, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET response = excluded.response, model = excluded.model, "
+                    "created_at = excluded.created_at, expires_at = excluded.expires_at",
+                    (key, response, model, now, now + ttl)
+                )
+        except sqlite3.Error as e:
+            logger.warning("LLM cache write error: %s", e)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        try:
+            with self._lock:
+                if self._conn is None:
+                    return {'error': 'not initialized'}
+                total = self._conn.execute(
+                    "SELECT COUNT(*) FROM responses WHERE expires_at > ?", (time.time(),)
+                ).fetchone()[0]
+            return {'size': total, 'db_path': self._db_str}
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+    
+    def close(self):
+        """Close the persistent connection"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
 class LLMAgent:
     """LLM Agent for generating intelligent responses"""
     
-    def __init__(self, model: str = "gpt-3.5-turbo", max_tokens: int = 500, temperature: float = 0.7):
+    def __init__(self, model: str = "gpt-3.5-turbo", max_tokens: int = 500, temperature: Optional[float] = None,
+                 cache_db_path: str = "llm_cache.db"):
         self.model = model
         self.max_tokens = max_tokens
+        if temperature is None:
+            temperature = float(os.getenv('OPENAI_TEMPERATURE', DEFAULT_OPENAI_TEMPERATURE))
         self.temperature = temperature
+        self.triage_model = os.getenv('OPENAI_TRIAGE_MODEL', DEFAULT_TRIAGE_MODEL)
         
         # Initialize OpenAI client
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        if not openai.api_key:
+        self.api_key = os.getenv('OPENAI_API_KEY')
+        self._client: Optional[AsyncOpenAI] = None
+        if not self.api_key:
             logger.warning("OPENAI_API_KEY not found. LLM responses will be disabled.")
             self.enabled = False
         else:
+            # One async client per agent on top of the shared httpx pool, so
+            # TCP/TLS connections are reused across requests. Retries are
+            # handled in _create_completion together with the rate limiter
+            self._client = AsyncOpenAI(api_key=self.api_key, max_retries=0, http_client=get_http_client())
             self.enabled = True
-            logger.info(f"LLM Agent initialized with model: {model}")
+            logger.info("LLM Agent initialized with model: %s", model)
+            logger.info("System prompt prefix hash: %s", _SYSTEM_PROMPT_HASH)
+        
+        # Cache of previous LLM answers for paraphrased repeats, backed by a persistent cache;
+        # both are created on first use, which only happens when caching is possible
+        # (see _get_cache_key), so a high-temperature agent opens no cache database
+        self._response_cache: Optional[SemanticCache] = None
+        self._disk_cache: Optional[DiskResponseCache] = None
+        self._cache_db_path = cache_db_path
+        
+        # Intent labels get their own small cache so they never evict answers;
+        # classification runs at temperature 0, so it needs no temperature gate
+        self.intent_cache = SemanticCache(max_size=INTENT_CACHE_SIZE, exact_max_size=INTENT_CACHE_SIZE)
+        
+        # Bounds in-flight OpenAI requests across all concurrent users
+        self.concurrency = int(os.getenv('OPENAI_CONCURRENCY', DEFAULT_OPENAI_CONCURRENCY))
+        self.rate_limit_rpm = int(os.getenv('OPENAI_RPM', DEFAULT_OPENAI_RPM))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._limiter = AsyncRateLimiter(self.rate_limit_rpm, 60)
+        
+        # Rolling summaries of older conversation turns per user:
+        # {'summary': str, 'last_timestamp': timestamp of the last summarized message}
+        # LRU bounded by SUMMARY_CACHE_USERS; an evicted user's summary is rebuilt from stored history
+        self._summaries: OrderedDict[int, Dict[str, str]] = OrderedDict()
+    
+    @property
+    def response_cache(self) -> SemanticCache:
+        """In-memory response cache, created on first use"""
+        if self._response_cache is None:
+            self._response_cache = SemanticCache()
+        return self._response_cache
+    
+    @property
+    def disk_cache(self) -> DiskResponseCache:
+        """Persistent response cache, opened on first use"""
+        if self._disk_cache is None:
+            self._disk_cache = DiskResponseCache(self._cache_db_path)
+        return self._disk_cache
     
     async def generate_response(
         self, 
         context: List[Dict[str, Any]], 
         user_message: str, 
-        knowledge: List[str]
+        knowledge: List[str],
+        user_id: Optional[int] = None
     ) -> str:
         """
         Generate response using OpenAI GPT-3.5-turbo
@@ -47,221 +682,536 @@ class LLMAgent:
             context: Conversation history as list of dicts with 'role' and 'content'
             user_message: Current user message
             knowledge: List of relevant knowledge snippets
+            user_id: Telegram user ID, enables rolling summary of older context
             
         Returns:
             Generated response string
         """
+        message_norm = _normalize_message(user_message)
         if not self.enabled:
-            return self._fallback_response(user_message, knowledge)
+            return self._fallback_response(message_norm, knowledge)
         
         try:
             # Check if message is about MCP tools
-            if self._is_mcp_related(user_message):
-                return await self._handle_mcp_request(user_message, context, knowledge)
-            
-            # Prepare system prompt
-            system_prompt = self._create_system_prompt()
+            if self._is_mcp_related(message_norm):
+                mcp_reply = await self._triage_mcp_request(message_norm, context, knowledge)
+                if mcp_reply is not None:
+                    return mcp_reply
             
-            # Prepare context for LLM
-            messages = [{"role": "system", "content": system_prompt}]
-            
-            # Add conversation context
-            if context:
-                # Limit context to last 6 messages to avoid token limits
-                recent_context = context[-6:]
-                for msg in recent_context:
-                    if msg['role'] in ['user', 'assistant']:
-                        messages.append({
-                            "role": msg['role'],
-                            "content": msg['content']
-                        })
-            
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
+            # Reuse a previous answer to a similar message when the turn allows it
+            cache_key = self._get_cache_key(context, knowledge)
+            if cache_key is not None:
+                cached_response = await self._get_cached_response(cache_key, message_norm)
+                if cached_response is not None:
+                    logger.debug("Cache hit for message: %.50s...", user_message)
+                    return cached_response
             
             # Generate response
+            messages = await self._build_messages(context, user_message, knowledge, user_id)
             response = await self._call_openai_api(messages)
             
-            logger.info(f"Generated LLM response for message: {user_message[:50]}...")
+            if cache_key is not None:
+                await self._cache_response(cache_key, message_norm, response)
+            
+            logger.info("Generated LLM response for message: %.50s...", user_message)
             return response
             
         except Exception as e:
-            logger.error(f"Error generating LLM response: {e}")
-            return self._fallback_response(user_message, knowledge)
+            logger.error("Error generating LLM response: %s", e)
+            return self._fallback_response(message_norm, knowledge)
     
-    def _create_system_prompt(self) -> str:
-        """Create system prompt for the LLM"""
-        return """Ты - интеллектуальный личный помощник для Telegram. 
-
-Твои возможности:
-- Управление календарем через Google Calendar
-- Отправка email-уведомлений через Gmail  
-- Поиск информации в интернете
-- Запоминание контекста разговоров
-- Семантический поиск в базе знаний
-
-Инструкции:
-1. Отвечай на русском языке
-2. Будь дружелюбным и полезным
-3. Используй предоставленные знания для более точных ответов
-4. Если пользователь просит создать событие, напомнить или отправить email - предложи соответствующие команды
-5. Если нужно найти информацию - используй поиск
-6. Помни контекст разговора и ссылайся на предыдущие сообщения
-
-Команды MCP:
-- /calendar "добавить событие дата название" - для создания событий
-- /email "отправить email@example.com: тема" - для отправки email
-- /search "запрос" - для поиска информации
-
-Отвечай кратко, но информативно."""
-    
-    async def _call_openai_api(self, messages: List[Dict[str, str]]) -> str:
-        """Call OpenAI API to generate response"""
+    async def generate_response_stream(
+        self,
+        context: List[Dict[str, Any]],
+        user_message: str,
+        knowledge: List[str],
+        user_id: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """
+        Generate response as a stream of text chunks
+        
+        Same routing, caching and fallbacks as generate_response, but LLM
+        output is yielded as it arrives so the reply can be shown before
+        the completion is finished. Canned, cached and fallback responses
+        are yielded as a single chunk.
+        
+        Args:
+            context: Conversation history as list of dicts with 'role' and 'content'
+            user_message: Current user message
+            knowledge: List of relevant knowledge snippets
+            user_id: Telegram user ID, enables rolling summary of older context
+            
+        Yields:
+            Response text chunks
+        """
+        message_norm = _normalize_message(user_message)
+        if not self.enabled:
+            yield self._fallback_response(message_norm, knowledge)
+            return
+        
+        if self._is_mcp_related(message_norm):
+            mcp_reply = await self._triage_mcp_request(message_norm, context, knowledge)
+            if mcp_reply is not None:
+                yield mcp_reply
+                return
+        
+        cache_key = self._get_cache_key(context, knowledge)
+        if cache_key is not None:
+            cached_response = await self._get_cached_response(cache_key, message_norm)
+            if cached_response is not None:
+                logger.debug("Cache hit for message: %.50s...", user_message)
+                yield cached_response
+                return
+        
+        chunks = []
         try:
-            response = openai.ChatCompletion.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature
+            messages = await self._build_messages(context, user_message, knowledge, user_id)
+            async for chunk in self._stream_openai_api(messages):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            logger.error("Error streaming LLM response: %s", e)
+            # Part of the answer was already delivered, nothing sensible to append
+            if not chunks:
+                yield self._fallback_response(message_norm, knowledge)
+            return
+        
+        response = "".join(chunks).strip()
+        if cache_key is not None and response:
+            await self._cache_response(cache_key, message_norm, response)
+        
+        logger.info("Streamed LLM response for message: %.50s...", user_message)
+    
+    def _get_cache_key(self, context: List[Dict[str, Any]], knowledge: List[str]) -> Optional[Tuple]:
+        """
+        Get response cache key for this turn, or None if its answer must not be reused
+        
+        Answers are cached only when sampling is near-deterministic and the turn
+        has no conversation history: with history (and its rolling summary) the
+        answer is written for one user and must not be served to another.
+        Retrieved knowledge is part of the prompt, so its digest is in the key.
+        """
+        if self.temperature > CACHE_MAX_TEMPERATURE or context:
+            return None
+        
+        # sha256-based hashes, unlike hash() they are stable across processes
+        knowledge_hash = hashlib.sha256("\n".join(knowledge).encode('utf-8')).hexdigest()[:12] if knowledge else ''
+        return (self.model, round(self.temperature, 1), _SYSTEM_PROMPT_HASH, knowledge_hash)
+    
+    async def _get_cached_response(self, cache_key: Tuple, message_norm: str) -> Optional[str]:
+        """Look up response in memory cache, then in the persistent cache off the event loop"""
+        cached_response = self.response_cache.get(cache_key, message_norm)
+        if cached_response is not None:
+            return cached_response
+        
+        cached_response = await asyncio.to_thread(
+            self.disk_cache.get, DiskResponseCache.make_key(cache_key, message_norm)
+        )
+        if cached_response is not None:
+            # Warm the memory cache for the following repeats
+            self.response_cache.put(cache_key, message_norm, cached_response)
+        return cached_response
+    
+    async def _cache_response(self, cache_key: Tuple, message_norm: str, response: str):
+        """Store response in memory and persistent caches, writing to disk off the event loop"""
+        self.response_cache.put(cache_key, message_norm, response)
+        
+        ttl = DISK_CACHE_VOLATILE_TTL if 'mcp_search' in _match_keywords(message_norm) else DISK_CACHE_TTL
+        await asyncio.to_thread(
+            self.disk_cache.put, DiskResponseCache.make_key(cache_key, message_norm), response, self.model, ttl
+        )
+    
+    async def _build_messages(
+        self,
+        context: List[Dict[str, Any]],
+        user_message: str,
+        knowledge: List[str],
+        user_id: Optional[int] = None
+    ) -> List[Dict[str, str]]:
+        """Build chat messages: system prompt, summary, history, knowledge, user message"""
+        messages = [{"role": "system", "content": self._create_system_prompt()}]
+        
+        # Add conversation context
+        if context:
+            # Older turns are condensed into a summary, only the last few go verbatim
+            summary = None
+            if user_id is not None and len(context) > CONTEXT_WINDOW + 2:
+                summary = await self._get_context_summary(user_id, context[:-CONTEXT_WINDOW])
+            
+            if summary:
+                messages.append({
+                    "role": "system",
+                    "content": f"Краткое содержание предыдущего разговора: {summary}"
+                })
+                window = CONTEXT_WINDOW
+            else:
+                window = len(context)
+            
+            # Keep the longest suffix of the window that fits the token budget
+            start = self._get_context_start(context, window, user_message, summary)
+            messages.extend(
+                {"role": msg['role'], "content": msg['content']}
+                for msg in islice(context, start, None)
+                if msg['role'] in _VALID_ROLES
             )
+        
+        # Add relevant knowledge after the history so the cached prefix stays intact
+        if knowledge:
+            messages.append({
+                "role": "system",
+                "content": "Релевантные знания:\n" + "\n".join(f"- {item}" for item in knowledge)
+            })
+        
+        # Add current user message
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
+    async def generate_many(
+        self,
+        jobs: List[Tuple[List[Dict[str, Any]], str, List[str]]]
+    ) -> List[str]:
+        """
+        Generate responses for several requests concurrently
+        
+        Args:
+            jobs: List of (context, user_message, knowledge) tuples
             
-            return response.choices[0].message.content.strip()
+        Returns:
+            Responses in the same order as jobs
+        """
+        return await asyncio.gather(*(self.generate_response(*job) for job in jobs))
+    
+    def _create_system_prompt(self) -> str:
+        """Create system prompt for the LLM"""
+        return _SYSTEM_PROMPT
+    
+    def _get_context_start(
+        self,
+        context: List[Dict[str, Any]],
+        window: int,
+        user_message: str,
+        summary: Optional[str] = None
+    ) -> int:
+        """
+        Find index of the first context message to send to the LLM
+        
+        Walks back from the newest message, at most window messages, while the
+        history fits into what is left of the model context after the system
+        prompt, summary, user message and the completion are accounted for.
+        
+        Args:
+            context: Conversation history
+            window: Max number of recent messages to consider
+            user_message: Current user message
+            summary: Rolling summary sent with the request, if any
             
-        except Exception as e:
-            logger.error(f"OpenAI API error: {e}")
-            raise
+        Returns:
+            Start index into context
+        """
+        model_tokens = MODEL_CONTEXT_TOKENS.get(self.model, DEFAULT_CONTEXT_TOKENS)
+        budget = min(
+            CONTEXT_TOKEN_BUDGET,
+            model_tokens
+            - self.max_tokens
+            - _count_tokens(_SYSTEM_PROMPT, self.model)
+            - _count_tokens(user_message, self.model)
+            - (_count_tokens(summary, self.model) if summary else 0)
+            - PROMPT_TOKEN_RESERVE
+        )
+        
+        start = len(context)
+        lower_bound = max(0, len(context) - window)
+        while start > lower_bound:
+            msg = context[start - 1]
+            if msg['role'] in _VALID_ROLES:
+                budget -= _count_tokens(msg['content'], self.model)
+                if budget < 0:
+                    break
+            start -= 1
+        
+        return start
     
-    def _is_mcp_related(self, message: str) -> bool:
-        """Check if message is related to MCP tools"""
-        message_lower = message.lower()
+    async def _get_context_summary(self, user_id: int, older_context: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Get rolling summary of older conversation turns
         
-        mcp_keywords = [
-            'календарь', 'calendar', 'событие', 'встреча', 'напоминание',
-            'email', 'почта', 'письмо', 'отправить', 'уведомление',
-            'поиск', 'search', 'найти', 'информация', 'погода', 'курс'
+        The summary is regenerated only after CONTEXT_WINDOW new messages have
+        dropped out of the raw window; the previous summary is folded into the
+        new one, so turns trimmed from memory are not lost.
+        
+        Args:
+            user_id: Telegram user ID
+            older_context: Messages preceding the raw context window
+            
+        Returns:
+            Summary string or None if no summary is available
+        """
+        state = self._summaries.get(user_id)
+        if state:
+            self._summaries.move_to_end(user_id)
+        last_timestamp = state['last_timestamp'] if state else ''
+        
+        pending = [
+            msg for msg in older_context
+            if msg.get('timestamp', '') > last_timestamp and msg['role'] in _VALID_ROLES
         ]
+        if state and len(pending) < CONTEXT_WINDOW:
+            return state['summary']
+        if not pending:
+            return None
         
-        return any(keyword in message_lower for keyword in mcp_keywords)
-    
-    async def _handle_mcp_request(self, message: str, context: List[Dict[str, Any]], knowledge: List[str]) -> str:
-        """Handle MCP-related requests"""
-        message_lower = message.lower()
-        
-        # Calendar related
-        if any(word in message_lower for word in ['календарь', 'calendar', 'событие', 'встреча', 'напоминание']):
-            return (
-                "Я могу помочь с управлением календарем! 📅\n\n"
-                "Используй команду:\n"
-                "/calendar \"добавить событие дата название\"\n\n"
-                "Примеры:\n"
-                "• /calendar \"добавить событие 10.10.2025 встреча с клиентом\"\n"
-                "• /calendar \"добавить событие завтра совещание\"\n"
-                "• /calendar \"добавить событие сегодня звонок\"\n\n"
-                "Поддерживаемые форматы дат: DD.MM.YYYY, \"сегодня\", \"завтра\""
-            )
+        dialogue = "\n".join(f"{msg['role']}: {msg['content']}" for msg in pending)
+        if state:
+            dialogue = f"Предыдущее краткое содержание: {state['summary']}\n\n{dialogue}"
         
-        # Email related
-        elif any(word in message_lower for word in ['email', 'почта', 'письмо', 'отправить', 'уведомление']):
-            return (
-                "Я могу отправлять email-уведомления! 📧\n\n"
-                "Используй команду:\n"
-                "/email \"отправить email@example.com: тема письма\"\n\n"
-                "Примеры:\n"
-                "• /email \"отправить reminder@example.com: встреча завтра\"\n"
-                "• /email \"отправить boss@company.com: отчет готов\"\n"
-                "• /email \"отправить friend@gmail.com: как дела?\"\n\n"
-                "Я автоматически добавлю информацию о времени отправки."
+        try:
+            summary = await self._call_openai_api(
+                [
+                    {
+                        "role": "system",
+                        "content": "Кратко перескажи диалог пользователя с ассистентом, сохранив факты, "
+                                   "договоренности и открытые вопросы. Не более 3 предложений."
+                    },
+                    {"role": "user", "content": dialogue}
+                ],
+                max_tokens=SUMMARY_MAX_TOKENS,
+                model=self.triage_model
             )
+        except Exception as e:
+            logger.error("Error summarizing context for user %s: %s", user_id, e)
+            return state['summary'] if state else None
         
-        # Search related
-        elif any(word in message_lower for word in ['поиск', 'search', 'найти', 'информация', 'погода', 'курс']):
-            return (
-                "Я могу искать информацию в интернете! 🔍\n\n"
-                "Используй команду:\n"
-                "/search \"запрос для поиска\"\n\n"
-                "Примеры:\n"
-                "• /search \"погода в Москве\"\n"
-                "• /search \"курс доллара\"\n"
-                "• /search \"новости технологий\"\n"
-                "• /search \"рецепт борща\"\n\n"
-                "Я найду актуальную информацию и покажу результаты."
-            )
+        self._summaries[user_id] = {
+            'summary': summary,
+            'last_timestamp': pending[-1].get('timestamp', '')
+        }
+        self._summaries.move_to_end(user_id)
+        if len(self._summaries) > SUMMARY_CACHE_USERS:
+            self._summaries.popitem(last=False)
+        logger.debug("Updated context summary for user %s", user_id)
+        return summary
+    
+    async def _call_openai_api(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        temperature: Optional[float] = None
+    ) -> str:
+        """Call OpenAI API to generate response, by default with the agent's model settings"""
+        async with self._semaphore:
+            response = await self._create_completion(messages, max_tokens, model=model, temperature=temperature)
         
-        # General MCP suggestion
-        else:
-            return (
-                "Я могу помочь с различными задачами! 🤖\n\n"
-                "Доступные команды:\n"
-                "📅 /calendar - управление календарем\n"
-                "📧 /email - отправка уведомлений\n"
-                "🔍 /search - поиск информации\n\n"
-                "Или просто напиши мне что-нибудь - я запоминаю наш разговор и могу помочь!"
-            )
+        return response.choices[0].message.content.strip()
+    
+    async def _stream_openai_api(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """Call OpenAI API with streaming and yield response text deltas"""
+        # The concurrency slot is held until the whole stream is consumed
+        async with self._semaphore:
+            stream = await self._create_completion(messages, max_tokens, stream=True)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    
+    async def _create_completion(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: Optional[int] = None,
+        stream: bool = False,
+        model: Optional[str] = None,
+        temperature: Optional[float] = None
+    ):
+        """
+        Create chat completion
+        
+        Rate limits, connection errors and 5xx responses are retried with
+        exponential backoff and jitter, honouring Retry-After when the API
+        sends it; other errors are raised immediately.
+        """
+        for attempt in range(1, OPENAI_MAX_RETRIES + 1):
+            try:
+                async with self._limiter:
+                    return await self._client.chat.completions.create(
+                        model=model or self.model,
+                        messages=messages,
+                        max_tokens=max_tokens or self.max_tokens,
+                        temperature=self.temperature if temperature is None else temperature,
+                        stream=stream
+                    )
+                
+            except RETRYABLE_ERRORS as e:
+                if attempt == OPENAI_MAX_RETRIES:
+                    logger.error("OpenAI API error after %d attempts: %s", attempt, e)
+                    raise
+                
+                delay = self._get_retry_delay(e, attempt)
+                logger.warning("OpenAI API error (attempt %d), retrying in %.1fs: %s", attempt, delay, e)
+                await asyncio.sleep(delay)
+                
+            except Exception as e:
+                logger.error("OpenAI API error: %s", e)
+                raise
     
-    def _fallback_response(self, user_message: str, knowledge: List[str]) -> str:
-        """Fallback response when LLM is not available"""
-        message_lower = user_message.lower()
+    @staticmethod
+    def _get_retry_delay(error: Exception, attempt: int) -> float:
+        """Get delay before the next retry: Retry-After if given, otherwise exponential backoff with jitter"""
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get('retry-after')
+            try:
+                if retry_after is not None:
+                    return min(float(retry_after), RETRY_MAX_DELAY)
+            except ValueError:
+                pass
         
-        # Simple keyword-based responses
-        if any(word in message_lower for word in ['привет', 'hello', 'hi', 'здравствуй']):
-            return "Привет! Рад тебя видеть! Как дела? Чем могу помочь?"
+        delay = min(RETRY_INITIAL_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    def _is_mcp_related(self, message_norm: str) -> bool:
+        """Check if normalized message is related to MCP tools"""
+        return not _MCP_LABELS.isdisjoint(_match_keywords(message_norm))
+    
+    async def _triage_mcp_request(
+        self,
+        message_norm: str,
+        context: List[Dict[str, Any]],
+        knowledge: List[str]
+    ) -> Optional[str]:
+        """
+        Decide how to answer a message that matched MCP keywords
         
-        elif any(word in message_lower for word in ['спасибо', 'thanks', 'thank you']):
-            return "Пожалуйста! Всегда рад помочь! 😊"
+        Keywords like "найти" or "информация" also occur in ordinary questions,
+        so the cheap triage model confirms the intent first. Messages naming
+        a tool ("календарь", "email", "поиск") are routed by keywords alone.
         
-        elif any(word in message_lower for word in ['календарь', 'calendar', 'событие']):
-            return (
-                "Я могу помочь с календарем! Используй команду:\n"
-                "/calendar \"добавить событие дата название\""
-            )
+        Returns:
+            Canned MCP help for calendar/email/search intents, None if the
+            message should be answered by the main model
+        """
+        if 'mcp_command' in _match_keywords(message_norm):
+            return self._handle_mcp_request(message_norm, context, knowledge)
         
-        elif any(word in message_lower for word in ['email', 'почта', 'письмо']):
-            return (
-                "Я могу отправлять email! Используй команду:\n"
-                "/email \"отправить email@example.com: тема\""
-            )
+        intent = await self._classify_intent(message_norm)
+        if intent is None:
+            # Triage unavailable, trust the keywords
+            return self._handle_mcp_request(message_norm, context, knowledge)
+        return _INTENT_REPLIES.get(intent)
+    
+    async def _classify_intent(self, message_norm: str) -> Optional[str]:
+        """
+        Classify normalized message as CALENDAR, EMAIL, SEARCH, CHAT or OTHER
         
-        elif any(word in message_lower for word in ['поиск', 'search', 'найти']):
-            return (
-                "Я могу искать информацию! Используй команду:\n"
-                "/search \"запрос для поиска\""
-            )
+        Uses the triage model; results are kept in the intent cache, so
+        repeated and paraphrased messages are classified once.
         
-        else:
-            return (
-                "Понял! Я запоминаю наш разговор и готов помочь.\n\n"
-                "Можешь использовать команды:\n"
-                "• /calendar - для событий\n"
-                "• /email - для уведомлений\n"
-                "• /search - для поиска\n"
-                "• /help - для справки"
+        Returns:
+            Intent name or None if classification failed
+        """
+        cache_key = (self.triage_model, *_INTENT_CACHE_KEY)
+        intent = self.intent_cache.get(cache_key, message_norm)
+        if intent is not None:
+            return intent
+        
+        try:
+            answer = await self._call_openai_api(
+                [
+                    {"role": "system", "content": _INTENT_PROMPT},
+                    {"role": "user", "content": message_norm}
+                ],
+                max_tokens=TRIAGE_MAX_TOKENS,
+                model=self.triage_model,
+                temperature=0
             )
+        except Exception as e:
+            logger.error("Error classifying intent: %s", e)
+            return None
+        
+        words = re.findall(r'[A-Z]+', answer.upper())
+        intent = words[0] if words and words[0] in _INTENTS else 'OTHER'
+        self.intent_cache.put(cache_key, message_norm, intent)
+        logger.debug("Classified intent %s for message: %.50s...", intent, message_norm)
+        return intent
+    
+    def _handle_mcp_request(self, message_norm: str, context: List[Dict[str, Any]], knowledge: List[str]) -> str:
+        """Handle MCP-related requests for normalized message"""
+        return _route_reply(message_norm, _MCP_REPLIES, _MCP_GENERAL_HELP)
+    
+    def _fallback_response(self, message_norm: str, knowledge: List[str]) -> str:
+        """Fallback response for normalized message when LLM is not available"""
+        return _route_reply(message_norm, _FALLBACK_REPLIES, _FALLBACK_DEFAULT)
     
     def get_stats(self) -> Dict[str, Any]:
         """Get LLM agent statistics"""
         return {
             'enabled': self.enabled,
             'model': self.model,
+            'triage_model': self.triage_model,
             'max_tokens': self.max_tokens,
             'temperature': self.temperature,
-            'api_key_configured': bool(openai.api_key)
+            'concurrency': self.concurrency,
+            'rate_limit_rpm': self.rate_limit_rpm,
+            'api_key_configured': bool(self.api_key),
+            'cache': self._response_cache.get_stats() if self._response_cache is not None else None,
+            'intent_cache': self.intent_cache.get_stats(),
+            'disk_cache': self._disk_cache.get_stats() if self._disk_cache is not None else None
         }
+    
+    def close(self):
+        """Close the persistent response cache, if it was opened"""
+        if self._disk_cache is not None:
+            self._disk_cache.close()
 
 
-# Global LLM agent instance
-llm_agent = LLMAgent()
+@lru_cache(maxsize=1)
+def get_agent() -> LLMAgent:
+    """
+    Get global LLM agent instance
+    
+    Created on first use rather than at import, so it sees environment
+    loaded by load_dotenv() and binds its async primitives inside the
+    running application.
+    """
+    return LLMAgent()
 
 
 # Convenience function
 async def generate_response(
     context: List[Dict[str, Any]], 
     user_message: str, 
-    knowledge: List[str]
+    knowledge: List[str],
+    user_id: Optional[int] = None
 ) -> str:
     """Convenience function to generate response"""
-    return await llm_agent.generate_response(context, user_message, knowledge)
+    return await get_agent().generate_response(context, user_message, knowledge, user_id)
+
+
+async def generate_response_stream(
+    context: List[Dict[str, Any]],
+    user_message: str,
+    knowledge: List[str],
+    user_id: Optional[int] = None
+) -> AsyncIterator[str]:
+    """Convenience function to stream response chunks"""
+    async for chunk in get_agent().generate_response_stream(context, user_message, knowledge, user_id):
+        yield chunk
+
+
+async def generate_many_responses(
+    jobs: List[Tuple[List[Dict[str, Any]], str, List[str]]]
+) -> List[str]:
+    """Convenience function to generate responses concurrently"""
+    return await get_agent().generate_many(jobs)
 
 
 def get_llm_stats() -> Dict[str, Any]:
     """Convenience function to get LLM stats"""
-    return llm_agent.get_stats()
+    return get_agent().get_stats()
+
+
+def close_response_cache():
+    """Close the persistent response cache, if the agent was created"""
+    if get_agent.cache_info().currsize:
+        get_agent().close()
@@ -7,14 +7,19 @@ import os
 import sys
 import logging
 import asyncio
+import time
+import re
 import json
+from collections import OrderedDict, deque
 from pathlib import Path
 from typing import Dict, Any, List
 from datetime import datetime
 
 from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     Application, 
+    BaseUpdateProcessor,
     CommandHandler, 
     MessageHandler, 
     filters, 
@@ -30,34 +35,47 @@ try:
 except ImportError:
     aiohttp = None
 
+# Fast JSON serialization for health endpoints (optional)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Faster event loop (optional, not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Import memory functions
-from memory import save_message, get_context, get_memory_stats
+from memory import (
+    memory,
+    save_message,
+    get_context,
+    get_memory_stats,
+    save_message_many_async,
+    get_context_async,
+    get_memory_stats_async
+)
 
 # Import vector database functions
 from vector_db import (
     search_knowledge, 
+    search_knowledge_batch,
     load_knowledge_from_json, 
     get_vector_db_stats,
-    save_vector_db
+    save_vector_db,
+    close_vector_db
 )
 
-# Import OpenAI
-import openai
-
-# Import MCP tools
-from tools import (
-    create_calendar_event,
-    send_email_notification, 
-    search_web,
-    check_all_mcp_health
-)
+# MCP tools are imported lazily in the handlers: the tools module pulls in
+# the Google API client and sets up credentials, which only commands need
 
 # Import LLM agent
-from agent import generate_response, get_llm_stats
+from agent import generate_response_stream, get_llm_stats, close_http_client, close_response_cache
 
-# Add the project root to Python path
+# Project root (for locating .env)
 project_root = Path(__file__).parent
-sys.path.insert(0, str(project_root))
 
 # Load environment variables
 load_dotenv()
@@ -72,6 +90,123 @@ logger = logging.getLogger(__name__)
 # Conversation states
 WAITING_FOR_MESSAGE = 1
 
+# Updates processed concurrently (different chats are served in parallel,
+# updates within one chat one at a time)
+DEFAULT_CONCURRENT_UPDATES = 32
+
+# Min seconds between edits of a streamed reply (Telegram rate-limits edits)
+STREAM_EDIT_INTERVAL = 0.5
+
+# Messages made only of these words are small talk and skip knowledge search
+SMALL_TALK_WORDS = frozenset({
+    "привет", "здравствуй", "здравствуйте", "добрый", "доброе", "день", "утро", "вечер",
+    "как", "дела", "спасибо", "благодарю", "пожалуйста", "пока", "ок", "окей", "хорошо",
+    "отлично", "понятно", "ясно", "да", "нет", "ага", "угу",
+    "hi", "hello", "hey", "thanks", "thank", "you", "ok", "okay", "yes", "no", "bye"
+})
+WORD_RE = re.compile(r'\w+')
+
+# Static replies
+WELCOME_TPL = (
+    "Привет, {username}! Я твой личный помощник для задач и напоминаний.\n\n"
+    "Я могу помочь тебе с:\n"
+    "• Управлением календарем через Google Calendar\n"
+    "• Отправкой email-уведомлений через Gmail\n"
+    "• Поиском информации в интернете\n"
+    "• Запоминанием контекста наших разговоров\n\n"
+    "Используй /help для списка команд или просто напиши мне что-нибудь!"
+)
+
+HELP_MSG = (
+    "Доступные команды:\n\n"
+    "📅 /calendar \"добавить событие дата название\"\n"
+    "📧 /email \"отправить email@example.com: тема\"\n"
+    "🔍 /search \"запрос для поиска\"\n"
+    "💚 /health - Проверка статуса агента\n"
+    "❓ /help - Показать это сообщение\n\n"
+    "Примеры:\n"
+    "• /calendar \"добавить событие 10.10.2025 встреча\"\n"
+    "• /email \"отправить reminder@example.com: встреча завтра\"\n"
+    "• /search \"погода в Москве\"\n\n"
+    "Также можешь просто писать мне сообщения - я запоминаю контекст наших разговоров!\n"
+    "+ Поиск в знаниях: спроси о задачах/напоминаниях.\n"
+    "+ LLM: использую OpenAI GPT-3.5 для умных ответов."
+)
+
+# Command argument parsing
+EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+CALENDAR_ADD_RE = re.compile(r'добавить событие', re.IGNORECASE)
+EMAIL_SEND_RE = re.compile(r'отправить', re.IGNORECASE)
+
+# Seconds to reuse serialized /health and /status responses
+HEALTH_CACHE_TTL = 1.0
+STATUS_CACHE_TTL = 5.0
+
+# Seconds to reuse MCP health probe results between /health calls
+MCP_HEALTH_TTL = 10
+
+# Conversation context kept in memory, written to SQLite in batches
+CONTEXT_CACHE_USERS = 10000
+MEMORY_FLUSH_INTERVAL = 0.5
+MEMORY_FLUSH_BATCH = 100  # Flush early once this many turns are queued
+
+
+def _dump_json(data: Dict[str, Any]) -> bytes:
+    """Serialize endpoint payload to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates concurrently across chats but one at a time within a chat
+    
+    Conversation state and the cached context are read-modify-write per user,
+    so two quick messages from the same chat must not build their prompts from
+    the same history or store their turns out of order.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        # The base class holds its semaphore while do_process_update runs, so an update
+        # waiting for its chat would occupy a slot; it only admits here, and the real
+        # limit is taken inside the chat lock below
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(sys.maxsize)
+        self._max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat id -> [lock, number of updates holding or waiting for it]
+        self._chat_locks: Dict[int, list] = {}
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Chat lock first: a backlog of one chat waits here without taking slots from others
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            # Drop the lock once no update of this chat is left, so the dict stays small
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+
 class TelegramAgentBot:
     """Main Telegram Bot class for the intelligent personal assistant"""
     
@@ -80,12 +215,38 @@ class TelegramAgentBot:
         if not self.token:
             raise ValueError("TELEGRAM_TOKEN not found in environment variables")
         
-        self.application = Application.builder().token(self.token).build()
-        self.user_sessions: Dict[int, Dict[str, Any]] = {}
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .concurrent_updates(PerChatUpdateProcessor(
+                int(os.getenv('TELEGRAM_CONCURRENT_UPDATES', DEFAULT_CONCURRENT_UPDATES))
+            ))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+        )
+        
+        # Keep outgoing calls within Telegram flood limits (needs the rate-limiter extra)
+        try:
+            builder = builder.rate_limiter(AIORateLimiter())
+        except RuntimeError:
+            logger.warning("aiolimiter not installed, Telegram rate limiting disabled")
+        
+        self.application = builder.build()
+        
+        # Per-user session state, one dict per field (context lives in _ctx_cache)
+        self.last_interaction: Dict[int, float] = {}
+        self.message_count: Dict[int, int] = {}
         
-        # Initialize OpenAI
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        self.openai_model = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+        # Recent messages per user, turns waiting to be flushed to SQLite and
+        # batches being written right now (not yet visible to database reads)
+        self._ctx_cache: OrderedDict[int, deque] = OrderedDict()
+        self._pending_writes: List[tuple] = []
+        self._flushing_writes: List[List[tuple]] = []
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task = None
+        
+        # Last MCP health probe result as (expires_at, result)
+        self._mcp_health_cache = None
         
         # Initialize MCP status (placeholders)
         self.mcp_status = {
@@ -101,6 +262,10 @@ class TelegramAgentBot:
         # Initialize health endpoint
         self.http_server_task = None
         self.app = None
+        
+        # Serialized endpoint responses as (expires_at, body)
+        self._health_cache = (0.0, b'')
+        self._status_cache = (0.0, b'')
 
         self._setup_handlers()
     
@@ -116,7 +281,7 @@ class TelegramAgentBot:
                 logger.warning("Failed to load sample knowledge")
                 self.mcp_status['vector_db'] = 'WARNING'
         except Exception as e:
-            logger.error(f"Error initializing vector database: {e}")
+            logger.error("Error initializing vector database: %s", e)
             self.mcp_status['vector_db'] = 'ERROR'
     
     def _setup_health_endpoint(self):
@@ -142,7 +307,7 @@ class TelegramAgentBot:
             logger.info("Health endpoint initialized on port 8000")
             
         except Exception as e:
-            logger.error(f"Error setting up health endpoint: {e}")
+            logger.error("Error setting up health endpoint: %s", e)
             self.http_server_task = None
     
     async def _start_http_server(self):
@@ -150,27 +315,32 @@ class TelegramAgentBot:
         try:
             runner = web.AppRunner(self.app)
             await runner.setup()
-            site = web.TCPSite(runner, '0.0.0.0', 8000)
+            site = web.TCPSite(runner, '0.0.0.0', 8000, reuse_port=sys.platform.startswith('linux'))
             await site.start()
             logger.info("HTTP server started on port 8000")
         except Exception as e:
-            logger.error(f"Error starting HTTP server: {e}")
+            logger.error("Error starting HTTP server: %s", e)
     
     async def _health_endpoint(self, request):
         """Health check endpoint for Docker"""
         try:
-            # Basic health check
-            health_data = {
-                "status": "healthy",
-                "timestamp": datetime.now().isoformat(),
-                "service": "telegram-agent-bot",
-                "version": "1.0.0"
-            }
+            now = time.monotonic()
+            expires_at, body = self._health_cache
+            if now >= expires_at:
+                # Basic health check
+                health_data = {
+                    "status": "healthy",
+                    "timestamp": datetime.now().isoformat(),
+                    "service": "telegram-agent-bot",
+                    "version": "1.0.0"
+                }
+                body = _dump_json(health_data)
+                self._health_cache = (now + HEALTH_CACHE_TTL, body)
             
-            return web.json_response(health_data)
+            return web.Response(body=body, content_type='application/json')
             
         except Exception as e:
-            logger.error(f"Health check error: {e}")
+            logger.error("Health check error: %s", e)
             return web.json_response(
                 {"status": "unhealthy", "error": str(e)}, 
                 status=500
@@ -179,10 +349,13 @@ class TelegramAgentBot:
     async def _status_endpoint(self, request):
         """Detailed status endpoint"""
         try:
+            now = time.monotonic()
+            expires_at, body = self._status_cache
+            if now < expires_at:
+                return web.Response(body=body, content_type='application/json')
+            
             # Get system status
-            memory_stats = get_memory_stats()
-            vector_stats = get_vector_db_stats()
-            llm_stats = get_llm_stats()
+            memory_stats, vector_stats, llm_stats = await self._get_component_stats()
             
             status_data = {
                 "status": "running",
@@ -196,7 +369,8 @@ class TelegramAgentBot:
                     },
                     "vector_db": {
                         "total_items": vector_stats.get('total_items', 0),
-                        "model": vector_stats.get('model_name', 'N/A')
+                        "model": vector_stats.get('model_name', 'N/A'),
+                        "snapshot_bytes": vector_stats.get('snapshot_bytes', 0)
                     },
                     "llm": {
                         "enabled": llm_stats.get('enabled', False),
@@ -206,10 +380,12 @@ class TelegramAgentBot:
                 }
             }
             
-            return web.json_response(status_data)
+            body = _dump_json(status_data)
+            self._status_cache = (now + STATUS_CACHE_TTL, body)
+            return web.Response(body=body, content_type='application/json')
             
         except Exception as e:
-            logger.error(f"Status check error: {e}")
+            logger.error("Status check error: %s", e)
             return web.json_response(
                 {"status": "error", "error": str(e)}, 
                 status=500
@@ -250,60 +426,27 @@ class TelegramAgentBot:
         username = update.effective_user.username or "пользователь"
         
         # Initialize user session
-        self.user_sessions[user_id] = {
-            'context': [],
-            'last_interaction': update.message.date,
-            'message_count': 0
-        }
-        
-        welcome_message = (
-            f"Привет, {username}! Я твой личный помощник для задач и напоминаний.\n\n"
-            "Я могу помочь тебе с:\n"
-            "• Управлением календарем через Google Calendar\n"
-            "• Отправкой email-уведомлений через Gmail\n"
-            "• Поиском информации в интернете\n"
-            "• Запоминанием контекста наших разговоров\n\n"
-            "Используй /help для списка команд или просто напиши мне что-нибудь!"
-        )
+        self.last_interaction[user_id] = time.monotonic()
+        self.message_count[user_id] = 0
         
-        await update.message.reply_text(welcome_message)
-        logger.info(f"User {user_id} ({username}) started the bot")
+        await update.message.reply_text(WELCOME_TPL.format(username=username))
+        logger.info("User %s (%s) started the bot", user_id, username)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        help_message = (
-            "Доступные команды:\n\n"
-            "📅 /calendar \"добавить событие дата название\"\n"
-            "📧 /email \"отправить email@example.com: тема\"\n"
-            "🔍 /search \"запрос для поиска\"\n"
-            "💚 /health - Проверка статуса агента\n"
-            "❓ /help - Показать это сообщение\n\n"
-            "Примеры:\n"
-            "• /calendar \"добавить событие 10.10.2025 встреча\"\n"
-            "• /email \"отправить reminder@example.com: встреча завтра\"\n"
-            "• /search \"погода в Москве\"\n\n"
-            "Также можешь просто писать мне сообщения - я запоминаю контекст наших разговоров!\n"
-            "+ Поиск в знаниях: спроси о задачах/напоминаниях.\n"
-            "+ LLM: использую OpenAI GPT-3.5 для умных ответов."
-        )
-        
-        await update.message.reply_text(help_message)
-        logger.info(f"User {update.effective_user.id} requested help")
+        await update.message.reply_text(HELP_MSG)
+        logger.info("User %s requested help", update.effective_user.id)
     
     async def health_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /health command"""
-        # Get memory statistics
-        memory_stats = get_memory_stats()
         test_user_id = 12345  # Test user for demonstration
         
-        # Get vector database statistics
-        vector_stats = get_vector_db_stats()
-        
-        # Get LLM agent statistics
-        llm_stats = get_llm_stats()
-        
-        # Check MCP tools health
-        mcp_health = await check_all_mcp_health()
+        # Get memory, vector database and LLM agent statistics along with MCP tools health
+        (memory_stats, vector_stats, llm_stats), test_context, mcp_health = await asyncio.gather(
+            self._get_component_stats(),
+            get_context_async(test_user_id),
+            self._get_mcp_health()
+        )
         
         # Format MCP status
         calendar_status = mcp_health['calendar']['status']
@@ -317,7 +460,7 @@ class TelegramAgentBot:
             f"MCP Search: {search_status}\n"
             f"MCP Vector DB: {self.mcp_status['vector_db']}\n"
             f"LLM Agent: {'✅' if llm_stats['enabled'] else '❌'} {llm_stats['model']}\n\n"
-            f"Память: {len(get_context(test_user_id))} сообщений (тест)\n"
+            f"Память: {len(test_context)} сообщений (тест)\n"
             f"Всего пользователей: {memory_stats.get('total_users', 0)}\n"
             f"Всего сообщений: {memory_stats.get('total_messages', 0)}\n"
             f"База знаний: {vector_stats.get('total_items', 0)} фактов\n"
@@ -333,7 +476,27 @@ class TelegramAgentBot:
             health_message += f"\n🔍 Поиск: {mcp_health['search'].get('test_results', 0)} результатов"
         
         await update.message.reply_text(health_message)
-        logger.info(f"Health check requested by user {update.effective_user.id}")
+        logger.info("Health check requested by user %s", update.effective_user.id)
+    
+    async def _get_component_stats(self) -> tuple:
+        """Get memory, vector database and LLM stats without blocking the event loop"""
+        return await asyncio.gather(
+            get_memory_stats_async(),
+            asyncio.to_thread(get_vector_db_stats),
+            asyncio.to_thread(get_llm_stats)
+        )
+    
+    async def _get_mcp_health(self) -> Dict[str, Any]:
+        """Get MCP health, probing the services at most once per MCP_HEALTH_TTL"""
+        now = asyncio.get_running_loop().time()
+        if self._mcp_health_cache and self._mcp_health_cache[0] > now:
+            return self._mcp_health_cache[1]
+        
+        from tools import check_all_mcp_health
+        
+        mcp_health = await check_all_mcp_health()
+        self._mcp_health_cache = (now + MCP_HEALTH_TTL, mcp_health)
+        return mcp_health
     
     async def calendar_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /calendar command"""
@@ -351,17 +514,17 @@ class TelegramAgentBot:
             command_text = " ".join(args)
             
             # Extract event details
-            if "добавить событие" in command_text.lower():
-                # Parse: "добавить событие DATE SUMMARY"
-                parts = command_text.split()
-                if len(parts) < 4:
+            if CALENDAR_ADD_RE.search(command_text):
+                # Parse: "добавить событие DATE SUMMARY" (args are single-space separated)
+                _, _, rest = command_text.partition(" ")
+                _, _, rest = rest.partition(" ")
+                date_str, _, summary = rest.partition(" ")  # Date, event title
+                if not summary:
                     await update.message.reply_text("Формат: /calendar \"добавить событие дата название\"")
                     return
                 
-                date_str = parts[2]  # Date
-                summary = " ".join(parts[3:])  # Event title
-                
                 # Create event
+                from tools import create_calendar_event
                 result = await create_calendar_event(summary, date_str)
                 
                 if result['success']:
@@ -375,7 +538,7 @@ class TelegramAgentBot:
                     response = f"❌ Ошибка MCP: {result['error']}"
                 
                 await update.message.reply_text(response)
-                logger.info(f"Calendar command executed by user {update.effective_user.id}")
+                logger.info("Calendar command executed by user %s", update.effective_user.id)
                 
             else:
                 await update.message.reply_text(
@@ -384,7 +547,7 @@ class TelegramAgentBot:
                 )
                 
         except Exception as e:
-            logger.error(f"Calendar command error: {e}")
+            logger.error("Calendar command error: %s", e)
             await update.message.reply_text(f"❌ Ошибка MCP: {str(e)}")
     
     async def email_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -402,23 +565,18 @@ class TelegramAgentBot:
             # Parse command
             command_text = " ".join(args)
             
-            if "отправить" in command_text.lower():
+            if EMAIL_SEND_RE.search(command_text):
                 # Parse: "отправить EMAIL: SUBJECT"
-                if ":" not in command_text:
+                email_part, sep, subject = command_text.partition(":")
+                if not sep:
                     await update.message.reply_text("Формат: /email \"отправить email@example.com: тема письма\"")
                     return
                 
-                parts = command_text.split(":", 1)
-                if len(parts) != 2:
-                    await update.message.reply_text("Формат: /email \"отправить email@example.com: тема письма\"")
-                    return
-                
-                email_part = parts[0].replace("отправить", "").strip()
-                subject = parts[1].strip()
+                email_part = email_part.replace("отправить", "")
+                subject = subject.strip()
                 
                 # Extract email address
-                import re
-                email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', email_part)
+                email_match = EMAIL_RE.search(email_part)
                 if not email_match:
                     await update.message.reply_text("Неверный формат email адреса")
                     return
@@ -429,6 +587,7 @@ class TelegramAgentBot:
                 body = f"Это автоматическое уведомление от Telegram Agent Bot.\n\n{subject}\n\nОтправлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
                 
                 # Send email
+                from tools import send_email_notification
                 result = await send_email_notification(to_email, subject, body)
                 
                 if result['success']:
@@ -442,7 +601,7 @@ class TelegramAgentBot:
                     response = f"❌ Ошибка MCP: {result['error']}"
                 
                 await update.message.reply_text(response)
-                logger.info(f"Email command executed by user {update.effective_user.id}")
+                logger.info("Email command executed by user %s", update.effective_user.id)
                 
             else:
                 await update.message.reply_text(
@@ -451,7 +610,7 @@ class TelegramAgentBot:
                 )
                 
         except Exception as e:
-            logger.error(f"Email command error: {e}")
+            logger.error("Email command error: %s", e)
             await update.message.reply_text(f"❌ Ошибка MCP: {str(e)}")
     
     async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -470,17 +629,17 @@ class TelegramAgentBot:
             query = " ".join(args)
             
             # Perform search
+            from tools import search_web
             result = await search_web(query, max_results=3)
             
             if result['success']:
-                response = f"🔍 Результаты поиска для \"{query}\":\n\n"
-                
-                for i, search_result in enumerate(result['results'], 1):
-                    response += f"{i}. **{search_result['title']}**\n"
-                    response += f"   {search_result['snippet'][:200]}...\n"
-                    if search_result.get('url'):
-                        response += f"   🔗 {search_result['url']}\n"
-                    response += "\n"
+                response = f"🔍 Результаты поиска для \"{query}\":\n\n" + "".join([
+                    f"{i}. **{search_result['title']}**\n"
+                    f"   {search_result['snippet'][:200]}...\n"
+                    + (f"   🔗 {search_result['url']}\n" if search_result.get('url') else "")
+                    + "\n"
+                    for i, search_result in enumerate(result['results'], 1)
+                ])
                 
                 # Limit response length
                 if len(response) > 4000:
@@ -490,10 +649,10 @@ class TelegramAgentBot:
                 response = f"❌ Ошибка MCP: {result['error']}"
             
             await update.message.reply_text(response)
-            logger.info(f"Search command executed by user {update.effective_user.id}")
+            logger.info("Search command executed by user %s", update.effective_user.id)
             
         except Exception as e:
-            logger.error(f"Search command error: {e}")
+            logger.error("Search command error: %s", e)
             await update.message.reply_text(f"❌ Ошибка MCP: {str(e)}")
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -502,49 +661,155 @@ class TelegramAgentBot:
         message_text = update.message.text
         username = update.effective_user.username or "пользователь"
         
-        # Load conversation context from database
-        conversation_context = get_context(user_id)
+        # Load conversation context from cache or database
+        conversation_context = await self._get_conversation_context(user_id)
         
-        # Generate contextual response based on history
-        response = await self._generate_response(user_id, message_text, conversation_context)
+        # Stream contextual response based on history into the reply
+        response = await self._reply_with_stream(update, user_id, message_text, conversation_context)
         
-        # Save the conversation to database
-        save_message(user_id, message_text, response)
+        # Remember the turn; the flush loop saves it to database
+        self._remember_turn(user_id, message_text, response)
+        self.last_interaction[user_id] = time.monotonic()
+        self.message_count[user_id] = self.message_count.get(user_id, 0) + 1
         
-        await update.message.reply_text(response)
-        logger.info(f"User {user_id} ({username}) sent message: {message_text[:50]}...")
+        logger.info("User %s (%s) sent message: %.50s...", user_id, username, message_text)
     
-    async def _generate_response(self, user_id: int, message: str, conversation_context: List[Dict[str, Any]]) -> str:
-        """Generate contextual response using LLM agent with knowledge and context"""
-
+    async def _reply_with_stream(
+        self,
+        update: Update,
+        user_id: int,
+        message: str,
+        conversation_context: List[Dict[str, Any]]
+    ) -> str:
+        """Reply with LLM response, editing the reply as new chunks arrive"""
+        loop = asyncio.get_running_loop()
+        reply = None
+        sent_text = ""
+        response = ""
+        last_edit = 0.0
+        
         try:
-            # Search in vector database for relevant knowledge
-            search_results = search_knowledge(message, top_k=3)
+            knowledge = self._search_knowledge(message)
             
-            # Extract knowledge snippets
-            knowledge = []
-            if search_results:
-                for text, score, metadata in search_results:
-                    knowledge.append(text)
+            async for chunk in generate_response_stream(conversation_context, message, knowledge, user_id):
+                response += chunk
+                text = response.strip()
+                if not text:
+                    continue
+                
+                # Telegram throttles edits, so the reply is updated at most every STREAM_EDIT_INTERVAL
+                now = loop.time()
+                if reply is None:
+                    reply = await update.message.reply_text(text)
+                    sent_text, last_edit = text, now
+                elif text != sent_text and now - last_edit >= STREAM_EDIT_INTERVAL:
+                    # An unchanged text would fail with "Message is not modified" and end the stream
+                    await reply.edit_text(text)
+                    sent_text, last_edit = text, now
             
-            # Generate response using LLM agent
-            response = await generate_response(conversation_context, message, knowledge)
+            logger.info("Generated LLM response for user %s", user_id)
             
-            logger.info(f"Generated LLM response for user {user_id}")
-            return response
-
         except Exception as e:
-            logger.error(f"Error generating LLM response: {e}")
-            
-            # Fallback to simple response
-            message_count = len([msg for msg in conversation_context if msg['role'] == 'user'])
-            context_info = f"Это сообщение #{message_count + 1} в нашей беседе."
-
-            return (
-                f"Понял! {context_info}\n\n"
-                "Я помню наш разговор и готов помочь. "
-                "Можешь спросить про календарь, email, поиск или просто поболтать!"
-            )
+            logger.error("Error generating LLM response: %s", e)
+        
+        response = response.strip() or self._fallback_text(conversation_context)
+        if reply is None:
+            await update.message.reply_text(response)
+        elif response != sent_text:
+            await reply.edit_text(response)
+        
+        return response
+    
+    async def _get_conversation_context(self, user_id: int) -> List[Dict[str, Any]]:
+        """Get recent messages for user, loading them from database on first access"""
+        history = self._ctx_cache.get(user_id)
+        if history is None:
+            stored = await get_context_async(user_id)
+            history = self._ctx_cache.get(user_id)
+            if history is None:
+                history = self._ctx_cache[user_id] = deque(stored, maxlen=memory.max_messages)
+                
+                # A user evicted from the cache may still have turns that are not in the
+                # database yet; they are newer than anything the read returned
+                last_timestamp = stored[-1]['timestamp'] if stored else ''
+                for batch in (*self._flushing_writes, self._pending_writes):
+                    for row_user_id, message, response, timestamp in batch:
+                        if row_user_id == user_id and timestamp > last_timestamp:
+                            self._append_turn(history, message, response, timestamp)
+                
+                if len(self._ctx_cache) > CONTEXT_CACHE_USERS:
+                    self._ctx_cache.popitem(last=False)
+        
+        self._ctx_cache.move_to_end(user_id)
+        return list(history)
+    
+    @staticmethod
+    def _append_turn(history: deque, message: str, response: str, timestamp: str):
+        """Append user message and bot response to a cached context"""
+        history.append({"role": "user", "content": message, "timestamp": timestamp})
+        history.append({"role": "assistant", "content": response, "timestamp": timestamp})
+    
+    def _remember_turn(self, user_id: int, message: str, response: str):
+        """Append turn to the cached context and queue it for database write"""
+        timestamp = datetime.now().isoformat()
+        history = self._ctx_cache.get(user_id)
+        if history is not None:
+            self._append_turn(history, message, response, timestamp)
+        
+        self._pending_writes.append((user_id, message, response, timestamp))
+        if len(self._pending_writes) >= MEMORY_FLUSH_BATCH:
+            self._flush_wakeup.set()
+    
+    async def _flush_loop(self):
+        """Write queued turns to database every MEMORY_FLUSH_INTERVAL or once a batch is full"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), MEMORY_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            await self._flush_pending_writes()
+    
+    async def _flush_pending_writes(self):
+        """Write all queued turns to database in one transaction"""
+        if not self._pending_writes:
+            return
+        
+        rows, self._pending_writes = self._pending_writes, []
+        self._flushing_writes.append(rows)
+        try:
+            if not await save_message_many_async(rows):
+                logger.error("Failed to save %s messages to memory database", len(rows))
+        finally:
+            self._flushing_writes.remove(rows)
+    
+    def _search_knowledge(self, message: str) -> List[str]:
+        """Search in vector database for knowledge snippets relevant to message"""
+        message_norm = message.strip().lower()
+        if set(WORD_RE.findall(message_norm)) <= SMALL_TALK_WORDS:
+            return []
+        
+        # Repeated queries are answered by the knowledge base's own search cache,
+        # which is invalidated whenever knowledge is added or reloaded
+        search_results = search_knowledge(message, top_k=3)
+        
+        knowledge = []
+        if search_results:
+            for text, score, metadata in search_results:
+                knowledge.append(text)
+        
+        return knowledge
+    
+    def _fallback_text(self, conversation_context: List[Dict[str, Any]]) -> str:
+        """Simple response used when LLM generation fails"""
+        message_count = len([msg for msg in conversation_context if msg['role'] == 'user'])
+        context_info = f"Это сообщение #{message_count + 1} в нашей беседе."
+        
+        return (
+            f"Понял! {context_info}\n\n"
+            "Я помню наш разговор и готов помочь. "
+            "Можешь спросить про календарь, email, поиск или просто поболтать!"
+        )
     
     
     async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -554,13 +819,38 @@ class TelegramAgentBot:
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle errors"""
-        logger.error(f"Update {update} caused error {context.error}")
+        logger.error("Update %s caused error %s", update, context.error)
         
         if update and update.effective_message:
             await update.effective_message.reply_text(
                 "Произошла ошибка. Попробуйте еще раз или используйте /help."
             )
     
+    async def _post_init(self, application: Application):
+        """Start background tasks once the bot event loop is running"""
+        self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def _post_shutdown(self, application: Application):
+        """Flush queued messages and release shared network resources after the bot stops"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self._flush_pending_writes()
+        memory.close()
+        close_vector_db()
+        close_response_cache()
+        
+        # tools is imported lazily by the handlers; nothing to close if it never was
+        tools = sys.modules.get('tools')
+        if tools is not None:
+            await tools.close_mcp_tools()
+        
+        await close_http_client()
+        logger.info("OpenAI HTTP client closed")
+    
     async def cleanup(self):
         """Cleanup resources"""
         if self.http_server_task and not self.http_server_task.done():
@@ -574,7 +864,7 @@ class TelegramAgentBot:
     def run(self):
         """Run the bot"""
         logger.info("Starting Telegram Agent Bot...")
-        logger.info(f"MCP Status: {self.mcp_status}")
+        logger.info("MCP Status: %s", self.mcp_status)
         
         # Setup health endpoint
         self._setup_health_endpoint()
@@ -588,7 +878,7 @@ class TelegramAgentBot:
         except KeyboardInterrupt:
             logger.info("Bot stopped by user")
         except Exception as e:
-            logger.error(f"Bot error: {e}")
+            logger.error("Bot error: %s", e)
         finally:
             # Cleanup
             if self.http_server_task:
@@ -605,10 +895,10 @@ def test_dialogue():
     # Test vector database
     print("--- Vector Database Test ---")
     try:
-        # Load knowledge
-        success = load_knowledge_from_json("knowledge.json")
-        if success:
-            print("+ Knowledge loaded successfully")
+        # Knowledge is loaded by the bot itself, only report what is there
+        total_items = get_vector_db_stats().get('total_items', 0)
+        if total_items:
+            print(f"+ Knowledge base has {total_items} items")
             
             # Test search
             test_queries = [
@@ -617,8 +907,7 @@ def test_dialogue():
                 "календарь события"
             ]
             
-            for query in test_queries:
-                results = search_knowledge(query, top_k=2)
+            for query, results in zip(test_queries, search_knowledge_batch(test_queries, top_k=2)):
                 print(f"\nQuery: '{query}'")
                 print(f"Found {len(results)} results:")
                 for i, (text, score, metadata) in enumerate(results, 1):
@@ -627,7 +916,7 @@ def test_dialogue():
                     if metadata:
                         print(f"     Category: {metadata.get('category', 'N/A')}")
         else:
-            print("- Failed to load knowledge")
+            print("- Knowledge base is empty")
     except Exception as e:
         print(f"- Vector DB error: {e}")
     
@@ -644,7 +933,10 @@ def test_dialogue():
     print(f"Simulating conversation for user {test_user_id}")
     print(f"Initial context: {len(get_context(test_user_id))} messages")
     
-    for i, message in enumerate(test_messages, 1):
+    # Vector search for all messages except the first one at once
+    message_results = [[]] + search_knowledge_batch(test_messages[1:], top_k=2)
+    
+    for i, (message, search_results) in enumerate(zip(test_messages, message_results), 1):
         print(f"\n--- Message {i} ---")
         print(f"User: {message}")
         
@@ -652,13 +944,11 @@ def test_dialogue():
         context = get_context(test_user_id)
         print(f"Context before: {len(context)} messages")
         
-        # Test vector search for this message
-        if i > 1:  # Skip first message
-            search_results = search_knowledge(message, top_k=2)
-            if search_results:
-                print(f"Vector search found {len(search_results)} relevant facts")
-                for text, score, metadata in search_results:
-                    print(f"  - {text[:60]}... (score: {score:.3f})")
+        # Vector search results for this message
+        if search_results:
+            print(f"Vector search found {len(search_results)} relevant facts")
+            for text, score, metadata in search_results:
+                print(f"  - {text[:60]}... (score: {score:.3f})")
         
         # Generate response (simplified)
         if "календарь" in message.lower():
@@ -717,6 +1007,16 @@ def test_dialogue():
     print("="*50)
 
 
+def _install_event_loop():
+    """Use uvloop for the bot event loop when available and not disabled via USE_UVLOOP=0"""
+    if uvloop is None or os.getenv('USE_UVLOOP', '1') == '0':
+        print("Event loop: asyncio")
+        return
+    
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    print("Event loop: uvloop")
+
+
 def main():
     """Main application entry point"""
     print("Agent starting...")
@@ -732,13 +1032,17 @@ def main():
     
     print("Environment file found")
     
-    # Test dialogue functionality
-    test_dialogue()
+    _install_event_loop()
     
     try:
         # Create and run the bot
         bot = TelegramAgentBot()
         print("Bot initialized successfully!")
+        
+        # Test dialogue functionality (skipped under python -O)
+        if __debug__:
+            test_dialogue()
+        
         print("Starting polling...")
         
         # Run the bot
@@ -749,7 +1053,7 @@ def main():
         print("Please check your .env file and ensure TELEGRAM_TOKEN is set")
     except Exception as e:
         print(f"Error starting bot: {e}")
-        logger.error(f"Failed to start bot: {e}")
+        logger.error("Failed to start bot: %s", e)
 
 if __name__ == "__main__":
     main()
@@ -5,13 +5,60 @@ Handles conversation context storage using SQLite
 """
 
 import sqlite3
+import asyncio
 import json
 import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+
+# Fast JSON for legacy history blobs (optional); orjson.JSONDecodeError subclasses json.JSONDecodeError
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Hot-path SQL, kept as constants so every call hits the connection's statement cache
+_SQL_INSERT_MESSAGE = "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)"
+_SQL_TRIM_HISTORY = """
+    DELETE FROM messages WHERE user_id = ? AND id <= (
+        SELECT id FROM messages WHERE user_id = ?
+        ORDER BY id DESC LIMIT 1 OFFSET ?
+    )
+"""
+_SQL_GET_HISTORY = """
+    SELECT role, content, timestamp FROM messages
+    WHERE user_id = ? ORDER BY id DESC LIMIT ?
+"""
+_SQL_DELETE_HISTORY = "DELETE FROM messages WHERE user_id = ?"
+_SQL_LIST_USERS = "SELECT DISTINCT user_id FROM messages"
+_SQL_COUNT = "SELECT COUNT(DISTINCT user_id), COUNT(*) FROM messages"
+
+# Per-connection SQLite tuning; journal_mode=WAL is persistent and set once at init
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+)
+
+
+def _message_row(cursor: sqlite3.Cursor, row: Tuple) -> Dict[str, Any]:
+    """Row factory building a context message straight from a _SQL_GET_HISTORY row"""
+    return {"role": row[0], "content": row[1], "timestamp": row[2]}
+
+
+def _loads(data: str) -> List[Dict[str, Any]]:
+    """Deserialize conversation history"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class ConversationMemory:
     """Handles conversation memory storage and retrieval"""
     
@@ -21,39 +68,126 @@ class ConversationMemory:
         data_dir.mkdir(exist_ok=True)
         
         self.db_path = data_dir / db_path
+        self._db_str = str(self.db_path)
         self.max_messages = 10  # Keep last 10 messages per user
         
+        # One connection per thread, reused across calls
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        
         # Initialize database
         self._init_database()
     
     def _init_database(self):
-        """Initialize SQLite database with conversations table"""
+        """Initialize SQLite database with messages table"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Create conversations table
+            # WAL lets readers run during writes and needs fewer fsyncs per commit
+            self._conn().execute("PRAGMA journal_mode=WAL")
+            
+            with self._transaction() as cursor:
+                # One row per message, so saving a turn never rewrites the history
                 cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS conversations (
-                        user_id INTEGER PRIMARY KEY,
-                        session_history TEXT NOT NULL DEFAULT '[]',
-                        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id INTEGER PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        timestamp TEXT NOT NULL
                     )
                 """)
                 
-                # Create index for better performance
+                # Latest messages of a user are read and trimmed by this index
                 cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_user_id 
-                    ON conversations(user_id)
+                    CREATE INDEX IF NOT EXISTS idx_messages_user 
+                    ON messages(user_id, id)
                 """)
                 
-                conn.commit()
+                self._migrate_conversations(cursor)
+                
                 logger.info(f"Database initialized at {self.db_path}")
                 
         except sqlite3.Error as e:
             logger.error(f"Database initialization error: {e}")
             raise
     
+    def _conn(self) -> sqlite3.Connection:
+        """Get this thread's database connection, opening it with tuned PRAGMAs on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # timeout doubles as busy_timeout when another connection holds the write lock;
+            # isolation_level=None leaves transactions to _transaction()
+            conn = sqlite3.connect(
+                self._db_str, timeout=5.0, isolation_level=None,
+                check_same_thread=False, cached_statements=256
+            )
+            for pragma in _CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    @contextmanager
+    def _cursor(self) -> Iterator[sqlite3.Cursor]:
+        """Cursor for read queries, each runs in its own implicit transaction"""
+        cursor = self._conn().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+    
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Cursor inside a write transaction, committed on success and rolled back on error"""
+        conn = self._conn()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        else:
+            cursor.execute("COMMIT")
+        finally:
+            cursor.close()
+    
+    def _migrate_conversations(self, cursor: sqlite3.Cursor):
+        """Move histories from the old JSON blob conversations table into messages"""
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'conversations'"
+        )
+        if not cursor.fetchone():
+            return
+        
+        cursor.execute("SELECT user_id, session_history FROM conversations")
+        rows = []
+        for user_id, session_history in cursor.fetchall():
+            try:
+                history = _loads(session_history)
+            except json.JSONDecodeError as e:
+                logger.error(f"Skipping unreadable history for user {user_id}: {e}")
+                continue
+            if not isinstance(history, list):
+                logger.error(f"Skipping history for user {user_id}: expected a list, got {type(history).__name__}")
+                continue
+            
+            for entry in history[-self.max_messages:]:
+                if not isinstance(entry, dict):
+                    logger.error(f"Skipping malformed message for user {user_id}: {entry!r:.50}")
+                    continue
+                rows.append((
+                    user_id,
+                    entry.get("role", "user"),
+                    entry.get("content", ""),
+                    entry.get("timestamp") or self._get_timestamp()
+                ))
+        
+        cursor.executemany(_SQL_INSERT_MESSAGE, rows)
+        cursor.execute("DROP TABLE conversations")
+        logger.info(f"Migrated {len(rows)} messages from conversations table")
+    
     def save_message(self, user_id: int, message: str, response: str) -> bool:
         """
         Save user message and bot response to database
@@ -66,53 +200,50 @@ class ConversationMemory:
         Returns:
             bool: True if successful, False otherwise
         """
+        return self.save_message_many([(user_id, message, response)])
+    
+    def save_message_many(self, rows: List[Tuple]) -> bool:
+        """
+        Save several message/response pairs in a single transaction
+        
+        Args:
+            rows: List of (user_id, message, response) or (user_id, message, response, timestamp)
+                in arrival order; turns without timestamp get the current time
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        if not rows:
+            return True
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Get existing conversation history
-                cursor.execute(
-                    "SELECT session_history FROM conversations WHERE user_id = ?",
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-                
-                if result:
-                    # Update existing conversation
-                    history = json.loads(result[0])
+            messages = []
+            default_timestamp = None
+            for row in rows:
+                user_id, message, response = row[:3]
+                if len(row) > 3:
+                    timestamp = row[3]
                 else:
-                    # Create new conversation
-                    history = []
-                
-                # Add new messages to history
-                history.append({
-                    "role": "user",
-                    "content": message,
-                    "timestamp": self._get_timestamp()
-                })
-                
-                history.append({
-                    "role": "assistant", 
-                    "content": response,
-                    "timestamp": self._get_timestamp()
-                })
-                
-                # Keep only last max_messages
-                if len(history) > self.max_messages:
-                    history = history[-self.max_messages:]
-                
-                # Save to database
-                cursor.execute("""
-                    INSERT OR REPLACE INTO conversations (user_id, session_history, last_updated)
-                    VALUES (?, ?, CURRENT_TIMESTAMP)
-                """, (user_id, json.dumps(history)))
-                
-                conn.commit()
-                logger.debug(f"Saved message for user {user_id}")
-                return True
+                    default_timestamp = default_timestamp or self._get_timestamp()
+                    timestamp = default_timestamp
+                messages.append((user_id, "user", message, timestamp))
+                messages.append((user_id, "assistant", response, timestamp))
+            user_ids = {row[0] for row in rows}
+            
+            with self._transaction() as cursor:
+                cursor.executemany(_SQL_INSERT_MESSAGE, messages)
                 
-        except (sqlite3.Error, json.JSONDecodeError) as e:
-            logger.error(f"Error saving message for user {user_id}: {e}")
+                # Keep only last max_messages per user
+                cursor.executemany(
+                    _SQL_TRIM_HISTORY,
+                    [(user_id, user_id, self.max_messages) for user_id in user_ids]
+                )
+            
+            logger.debug(f"Saved {len(rows)} messages for {len(user_ids)} users")
+            return True
+            
+        except sqlite3.Error as e:
+            logger.error(f"Error saving {len(rows)} messages: {e}")
             return False
     
     def get_context(self, user_id: int) -> List[Dict[str, Any]]:
@@ -126,24 +257,18 @@ class ConversationMemory:
             List of conversation messages with role and content
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "SELECT session_history FROM conversations WHERE user_id = ?",
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-                
-                if result:
-                    history = json.loads(result[0])
-                    logger.debug(f"Retrieved {len(history)} messages for user {user_id}")
-                    return history
-                else:
-                    logger.debug(f"No conversation history found for user {user_id}")
-                    return []
+            # Recent context is cached by the bot (TelegramAgentBot._ctx_cache), so every
+            # call here is a cache miss and goes straight to the database
+            with self._cursor() as cursor:
+                cursor.row_factory = _message_row
+                cursor.execute(_SQL_GET_HISTORY, (user_id, self.max_messages))
+                history = cursor.fetchall()
+            history.reverse()
+            
+            logger.debug(f"Retrieved {len(history)} messages for user {user_id}")
+            return history
                     
-        except (sqlite3.Error, json.JSONDecodeError) as e:
+        except sqlite3.Error as e:
             logger.error(f"Error retrieving context for user {user_id}: {e}")
             return []
     
@@ -158,17 +283,11 @@ class ConversationMemory:
             bool: True if successful, False otherwise
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "DELETE FROM conversations WHERE user_id = ?",
-                    (user_id,)
-                )
-                
-                conn.commit()
-                logger.info(f"Cleared conversation history for user {user_id}")
-                return True
+            with self._transaction() as cursor:
+                cursor.execute(_SQL_DELETE_HISTORY, (user_id,))
+            
+            logger.info(f"Cleared conversation history for user {user_id}")
+            return True
                 
         except sqlite3.Error as e:
             logger.error(f"Error clearing context for user {user_id}: {e}")
@@ -181,18 +300,30 @@ class ConversationMemory:
         Returns:
             List of user IDs
         """
+        return list(self.iter_all_users())
+    
+    def iter_all_users(self, batch_size: int = 1000) -> Iterator[int]:
+        """
+        Iterate over user IDs with conversation history without loading them all at once
+        
+        Args:
+            batch_size: Number of rows fetched from SQLite per round trip
+            
+        Yields:
+            User IDs
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute("SELECT user_id FROM conversations")
-                results = cursor.fetchall()
-                
-                return [row[0] for row in results]
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_LIST_USERS)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row[0]
                 
         except sqlite3.Error as e:
             logger.error(f"Error getting user list: {e}")
-            return []
     
     def get_stats(self) -> Dict[str, Any]:
         """
@@ -202,43 +333,38 @@ class ConversationMemory:
             Dictionary with database stats
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Count total users
-                cursor.execute("SELECT COUNT(*) FROM conversations")
-                total_users = cursor.fetchone()[0]
-                
-                # Count total messages
-                cursor.execute("SELECT session_history FROM conversations")
-                results = cursor.fetchall()
-                
-                total_messages = 0
-                for result in results:
-                    history = json.loads(result[0])
-                    total_messages += len(history)
+            with self._cursor() as cursor:
+                # Count total users and messages in one pass over idx_messages_user
+                cursor.execute(_SQL_COUNT)
+                total_users, total_messages = cursor.fetchone()
                 
                 return {
                     "total_users": total_users,
                     "total_messages": total_messages,
-                    "database_path": str(self.db_path),
+                    "database_path": self._db_str,
                     "max_messages_per_user": self.max_messages
                 }
                 
-        except (sqlite3.Error, json.JSONDecodeError) as e:
+        except sqlite3.Error as e:
             logger.error(f"Error getting database stats: {e}")
             return {"error": str(e)}
     
     def _get_timestamp(self) -> str:
         """Get current timestamp as string"""
-        from datetime import datetime
         return datetime.now().isoformat()
     
     def close(self):
-        """Close database connection (if needed)"""
-        # SQLite connections are automatically closed, but this method
-        # can be used for cleanup if needed in the future
-        pass
+        """Checkpoint the WAL into the database file and close all connections"""
+        with self._connections_lock:
+            if self._connections:
+                try:
+                    self._connections[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    logger.error(f"WAL checkpoint error: {e}")
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
 
 
 # Global memory instance
@@ -250,6 +376,11 @@ def save_message(user_id: int, message: str, response: str) -> bool:
     return memory.save_message(user_id, message, response)
 
 
+def save_message_many(rows: List[Tuple]) -> bool:
+    """Convenience function to save several messages at once"""
+    return memory.save_message_many(rows)
+
+
 def get_context(user_id: int) -> List[Dict[str, Any]]:
     """Convenience function to get context"""
     return memory.get_context(user_id)
@@ -263,3 +394,21 @@ def clear_context(user_id: int) -> bool:
 def get_memory_stats() -> Dict[str, Any]:
     """Convenience function to get memory stats"""
     return memory.get_stats()
+
+
+# Async convenience functions: SQLite runs in a worker thread (each thread keeps
+# its own connection), so the event loop is never blocked by disk I/O
+
+async def save_message_many_async(rows: List[Tuple]) -> bool:
+    """Save several messages at once without blocking the event loop"""
+    return await asyncio.to_thread(memory.save_message_many, rows)
+
+
+async def get_context_async(user_id: int) -> List[Dict[str, Any]]:
+    """Get context without blocking the event loop"""
+    return await asyncio.to_thread(memory.get_context, user_id)
+
+
+async def get_memory_stats_async() -> Dict[str, Any]:
+    """Get memory stats without blocking the event loop"""
+    return await asyncio.to_thread(memory.get_stats)
@@ -5,7 +5,7 @@ Unit tests for Telegram Agent Bot MCP Tools
 
 import pytest
 import asyncio
-from unittest.mock import Mock, patch, AsyncMock
+from unittest.mock import Mock, MagicMock, patch, AsyncMock
 import json
 from datetime import datetime
 
@@ -13,18 +13,43 @@ from datetime import datetime
 from tools import MCPTools, create_calendar_event, send_email_notification, search_web
 
 
+@pytest.fixture
+def make_agent(tmp_path):
+    """Create LLM agents whose persistent cache lives in a temporary directory"""
+    from agent import LLMAgent
+
+    agents = []
+
+    def make(**kwargs):
+        with patch.dict('os.environ', {'OPENAI_API_KEY': 'mock_openai_key_for_testing'}):
+            agent = LLMAgent(cache_db_path=str(tmp_path / "llm_cache.db"), **kwargs)
+        agents.append(agent)
+        return agent
+
+    yield make
+    for agent in agents:
+        agent.close()
+
+
 class TestMCPTools:
     """Test cases for MCP Tools"""
     
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def mcp_tools(self):
-        """Create MCPTools instance for testing"""
+        """Create MCPTools instance once for all tests in this module"""
         with patch('tools.build') as mock_build:
             tools = MCPTools()
             tools.calendar_service = Mock()
             tools.gmail_service = Mock()
             return tools
     
+    @pytest.fixture(autouse=True)
+    def reset_services(self, mcp_tools):
+        """Reset service mocks so configured responses do not leak between tests"""
+        mcp_tools.calendar_service.reset_mock(return_value=True, side_effect=True)
+        mcp_tools.gmail_service.reset_mock(return_value=True, side_effect=True)
+        mcp_tools._search_cache.clear()
+    
     @pytest.mark.asyncio
     async def test_create_event_success(self, mcp_tools):
         """Test successful calendar event creation"""
@@ -52,20 +77,6 @@ class TestMCPTools:
         assert 'error' in result
         assert 'Invalid date format' in result['error']
     
-    @pytest.mark.asyncio
-    async def test_create_event_api_error(self, mcp_tools):
-        """Test calendar event creation with API error"""
-        from googleapiclient.errors import HttpError
-        
-        # Mock API error
-        error = HttpError(Mock(), b'{"error": "API Error"}')
-        mcp_tools.calendar_service.events().insert().execute.side_effect = error
-        
-        result = await mcp_tools.create_event("Test Meeting", "10.10.2025")
-        
-        assert result['success'] is False
-        assert 'Calendar API error' in result['error']
-    
     @pytest.mark.asyncio
     async def test_send_email_success(self, mcp_tools):
         """Test successful email sending"""
@@ -82,18 +93,50 @@ class TestMCPTools:
         assert result['subject'] == "Test Subject"
     
     @pytest.mark.asyncio
-    async def test_send_email_api_error(self, mcp_tools):
-        """Test email sending with API error"""
+    async def test_create_events_batch(self, mcp_tools):
+        """Test that valid events go out in one batch and results keep input order"""
+        batch = Mock()
+        added = []
+        batch.add.side_effect = lambda request, request_id: added.append(request_id)
+
+        def execute(http=None):
+            callback = mcp_tools.calendar_service.new_batch_http_request.call_args.kwargs['callback']
+            for request_id in added:
+                callback(request_id, {'id': f'event_{request_id}', 'htmlLink': ''}, None)
+
+        batch.execute.side_effect = execute
+        mcp_tools.calendar_service.new_batch_http_request.return_value = batch
+
+        results = await mcp_tools.create_events_batch([
+            ("First", "10.10.2025"),
+            ("Broken", "invalid_date"),
+            ("Second", "завтра")
+        ])
+
+        assert batch.execute.call_count == 1
+        assert [r['success'] for r in results] == [True, False, True]
+        assert results[0]['event_id'] == 'event_0'
+        assert results[2]['event_id'] == 'event_1'
+        assert 'Invalid date format' in results[1]['error']
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("execute, method, args, error_text", [
+        (lambda tools: tools.calendar_service.events().insert().execute,
+         "create_event", ("Test Meeting", "10.10.2025"), "Calendar API error"),
+        (lambda tools: tools.gmail_service.users().messages().send().execute,
+         "send_email", ("test@example.com", "Test Subject", "Test Body"), "Gmail API error"),
+    ], ids=["calendar", "gmail"])
+    async def test_api_error(self, mcp_tools, execute, method, args, error_text):
+        """Test that Google API errors are reported instead of raised"""
         from googleapiclient.errors import HttpError
         
         # Mock API error
-        error = HttpError(Mock(), b'{"error": "API Error"}')
-        mcp_tools.gmail_service.users().messages().send().execute.side_effect = error
+        execute(mcp_tools).side_effect = HttpError(Mock(), b'{"error": "API Error"}')
         
-        result = await mcp_tools.send_email("test@example.com", "Test Subject", "Test Body")
+        result = await getattr(mcp_tools, method)(*args)
         
         assert result['success'] is False
-        assert 'Gmail API error' in result['error']
+        assert error_text in result['error']
     
     @pytest.mark.asyncio
     async def test_web_search_success(self, mcp_tools):
@@ -111,10 +154,12 @@ class TestMCPTools:
             ]
         }
         
-        with patch('tools.requests.get') as mock_get:
-            mock_get.return_value.json.return_value = mock_response
-            mock_get.return_value.raise_for_status.return_value = None
-            
+        session = MagicMock()
+        response = session.get.return_value.__aenter__.return_value
+        response.json = AsyncMock(return_value=mock_response)
+        response.raise_for_status = Mock(return_value=None)
+        
+        with patch.object(mcp_tools, '_get_http_session', return_value=session):
             result = await mcp_tools.web_search("test query")
             
             assert result['success'] is True
@@ -122,19 +167,80 @@ class TestMCPTools:
             assert len(result['results']) > 0
             assert result['results'][0]['type'] == 'abstract'
     
+    @pytest.mark.asyncio
+    async def test_web_search_cached(self, mcp_tools):
+        """Test that a repeated search is answered from cache"""
+        session = MagicMock()
+        response = session.get.return_value.__aenter__.return_value
+        response.json = AsyncMock(return_value={'Abstract': 'Cached', 'Heading': 'Test'})
+        response.raise_for_status = Mock(return_value=None)
+        
+        with patch.object(mcp_tools, '_get_http_session', return_value=session):
+            first = await mcp_tools.web_search("cached query")
+            second = await mcp_tools.web_search("cached query")
+            
+            assert first == second
+            assert session.get.call_count == 1
+    
     @pytest.mark.asyncio
     async def test_web_search_request_error(self, mcp_tools):
         """Test web search with request error"""
-        import requests
+        import aiohttp
         
-        with patch('tools.requests.get') as mock_get:
-            mock_get.side_effect = requests.RequestException("Network error")
-            
+        session = MagicMock()
+        session.get.side_effect = aiohttp.ClientError("Network error")
+        
+        with patch.object(mcp_tools, '_get_http_session', return_value=session):
             result = await mcp_tools.web_search("test query")
             
             assert result['success'] is False
             assert 'Search request failed' in result['error']
     
+    @pytest.mark.asyncio
+    async def test_concurrent_calls_use_thread_local_http(self):
+        """Test that API calls running in parallel threads never share an HTTP client"""
+        import threading
+
+        tools = MCPTools.__new__(MCPTools)
+        tools._local = threading.local()
+        tools.credentials = Mock()
+        barrier = threading.Barrier(2, timeout=5)
+        used = []
+
+        def execute(http):
+            # Both calls are in flight at once, so they run in different threads
+            barrier.wait()
+            used.append((threading.get_ident(), http, tools._thread_http()))
+
+        request = Mock()
+        request.execute.side_effect = execute
+        await asyncio.gather(
+            asyncio.to_thread(tools._execute, request),
+            asyncio.to_thread(tools._execute, request),
+        )
+
+        (first_thread, first_http, first_again), (second_thread, second_http, second_again) = used
+        assert first_thread != second_thread
+        assert first_http is not second_http
+        assert first_http is first_again and second_http is second_again
+    
+    @pytest.mark.asyncio
+    async def test_token_refresh_is_scheduled_before_expiry(self):
+        """Test that the refresher waits until TOKEN_REFRESH_MARGIN before the naive UTC expiry"""
+        from datetime import timedelta, timezone
+        from tools import TOKEN_REFRESH_MARGIN
+
+        tools = MCPTools.__new__(MCPTools)
+        tools.credentials = Mock()
+        expiry = datetime.now(timezone.utc) + timedelta(seconds=TOKEN_REFRESH_MARGIN + 600)
+        tools.credentials.expiry = expiry.replace(tzinfo=None)
+
+        with patch('tools.asyncio.sleep', AsyncMock(side_effect=asyncio.CancelledError)) as sleep:
+            with pytest.raises(asyncio.CancelledError):
+                await tools._token_refresher()
+
+        assert 590 < sleep.await_args.args[0] <= 600
+    
     def test_parse_date_formats(self, mcp_tools):
         """Test date parsing with different formats"""
         # Test DD.MM.YYYY format
@@ -239,6 +345,752 @@ class TestConvenienceFunctions:
             mock_search.assert_called_once_with("test query", 3)
 
 
+class TestSemanticCache:
+    """Test cases for the LLM response cache"""
+    
+    def test_paraphrase_hit(self):
+        """Test that a paraphrased message reuses the cached response"""
+        from agent import SemanticCache
+        
+        cache = SemanticCache()
+        key = ("gpt-3.5-turbo", 0.0, 1)
+        cache.put(key, "погода в москве", "Солнечно")
+        
+        assert cache.get(key, "какая погода в москве") == "Солнечно"
+        assert cache.get(key, "отправь письмо") is None
+    
+    def test_negation_and_number_miss(self):
+        """Test that messages differing in a negation or a number are not paraphrases"""
+        from agent import SemanticCache
+        
+        cache = SemanticCache()
+        key = ("gpt-3.5-turbo", 0.0, 1)
+        cache.put(key, "я люблю кошек", "Кошки милые")
+        cache.put(key, "напомни про встречу с командой в 10", "Напомню в 10")
+        
+        assert cache.get(key, "я не люблю кошек") is None
+        assert cache.get(key, "напомни про встречу с командой в 11") is None
+        assert cache.get(key, "напомни мне про встречу с командой в 10") == "Напомню в 10"
+    
+    def test_key_isolation(self):
+        """Test that responses are not shared between cache keys"""
+        from agent import SemanticCache
+        
+        cache = SemanticCache()
+        cache.put(("gpt-3.5-turbo", 0.0, 1), "привет", "Привет!")
+        
+        assert cache.get(("gpt-4", 0.0, 1), "привет") is None
+    
+    def test_exact_repeat_lru_eviction(self):
+        """Test exact repeats hit and the oldest exact entry is evicted"""
+        from agent import SemanticCache
+        
+        cache = SemanticCache(exact_max_size=1)
+        key = ("gpt-3.5-turbo", 0.0, 1)
+        cache.put(key, "!!!", "first")
+        assert cache.get(key, "!!!") == "first"
+        
+        cache.put(key, "???", "second")
+        assert cache.get(key, "!!!") is None
+        assert cache.get(key, "???") == "second"
+
+    def test_agent_cache_key_scope(self, make_agent):
+        """Test that only context-free, low-temperature turns get a cache key"""
+        agent = make_agent(temperature=0.0)
+        hot_agent = make_agent(temperature=0.7)
+
+        history = [{"role": "user", "content": "меня зовут Аня"}]
+        assert agent._get_cache_key(history, []) is None
+        assert hot_agent._get_cache_key([], []) is None
+        assert agent._get_cache_key([], ["факт"]) != agent._get_cache_key([], ["другой факт"])
+
+    def test_hot_agent_opens_no_cache(self, make_agent, tmp_path):
+        """Test that an agent that cannot cache never creates its response caches"""
+        agent = make_agent(temperature=0.7)
+
+        assert agent.get_stats()['cache'] is None
+        assert agent._disk_cache is None
+        assert not (tmp_path / "llm_cache.db").exists()
+
+    @pytest.mark.asyncio
+    async def test_disk_cache_ttl(self, make_agent):
+        """Test that search answers expire sooner and expired answers are misses"""
+        from agent import DISK_CACHE_TTL, DISK_CACHE_VOLATILE_TTL
+
+        agent = make_agent(temperature=0.0)
+        key = agent._get_cache_key([], [])
+        now = 1_000_000.0
+
+        with patch('agent.time.time', return_value=now):
+            await agent._cache_response(key, "погода в москве", "Солнечно")
+            await agent._cache_response(key, "что такое python", "Язык программирования")
+
+        # A new agent starts with an empty memory cache, so answers come from disk
+        with patch('agent.time.time', return_value=now + DISK_CACHE_VOLATILE_TTL + 1):
+            restarted = make_agent(temperature=0.0)
+            assert await restarted._get_cached_response(key, "погода в москве") is None
+            assert await restarted._get_cached_response(key, "что такое python") == "Язык программирования"
+
+        with patch('agent.time.time', return_value=now + DISK_CACHE_TTL + 1):
+            restarted = make_agent(temperature=0.0)
+            assert await restarted._get_cached_response(key, "что такое python") is None
+
+    @pytest.mark.asyncio
+    async def test_disk_hit_warms_memory_cache(self, make_agent):
+        """Test that an answer found on disk is served from memory next time"""
+        from agent import DiskResponseCache
+
+        agent = make_agent(temperature=0.0)
+        key = agent._get_cache_key([], [])
+        agent.disk_cache.put(DiskResponseCache.make_key(key, "как дела"), "Хорошо", agent.model)
+
+        assert agent.response_cache.get(key, "как дела") is None
+        assert await agent._get_cached_response(key, "как дела") == "Хорошо"
+        assert agent.response_cache.get(key, "как дела") == "Хорошо"
+
+
+class TestLLMAgentRetry:
+    """Test cases for OpenAI call retries"""
+    
+    @pytest.mark.asyncio
+    async def test_rate_limit_is_retried(self, make_agent):
+        """Test that a rate-limited request is retried and then succeeds"""
+        import httpx
+        import openai
+        
+        agent = make_agent()
+        
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        rate_limit = openai.RateLimitError(
+            "Rate limit",
+            response=httpx.Response(429, headers={'retry-after': '0'}, request=request),
+            body=None
+        )
+        completion = Mock()
+        completion.choices = [Mock()]
+        completion.choices[0].message.content = " Ответ "
+        agent._client.chat.completions.create = AsyncMock(side_effect=[rate_limit, completion])
+        
+        result = await agent._call_openai_api([{"role": "user", "content": "Привет"}])
+        
+        assert result == "Ответ"
+        assert agent._client.chat.completions.create.call_count == 2
+
+
+class TestContextCache:
+    """Test cases for the bot's per-user context cache"""
+
+    @pytest.mark.asyncio
+    async def test_evicted_user_sees_unsaved_turns(self):
+        """Test that reloading an evicted user's context includes turns not yet in the database"""
+        from collections import OrderedDict
+        from main import TelegramAgentBot
+
+        bot = TelegramAgentBot.__new__(TelegramAgentBot)
+        bot._ctx_cache = OrderedDict()
+        bot._pending_writes = []
+        bot._flushing_writes = [[(1, "в записи", "ответ 2", "2025-01-01T00:00:02")]]
+        bot._flush_wakeup = asyncio.Event()
+        stored = [
+            {"role": "user", "content": "сохранено", "timestamp": "2025-01-01T00:00:01"},
+            {"role": "assistant", "content": "ответ 1", "timestamp": "2025-01-01T00:00:01"},
+        ]
+
+        with patch('main.get_context_async', AsyncMock(return_value=stored)), \
+             patch('main.CONTEXT_CACHE_USERS', 1):
+            bot._remember_turn(1, "в очереди", "ответ 3")
+            await bot._get_conversation_context(2)
+            assert 1 not in bot._ctx_cache
+
+            context = await bot._get_conversation_context(1)
+
+        assert [msg["content"] for msg in context] == [
+            "сохранено", "ответ 1", "в записи", "ответ 2", "в очереди", "ответ 3"
+        ]
+
+class TestCommandParsing:
+    """Test cases for /calendar and /email argument parsing"""
+
+    @staticmethod
+    def make_call(args):
+        """Build a bot without running its constructor, an update and a context with args"""
+        from main import TelegramAgentBot
+
+        bot = TelegramAgentBot.__new__(TelegramAgentBot)
+        update = Mock()
+        update.message.reply_text = AsyncMock()
+        context = Mock()
+        context.args = args
+        return bot, update, context
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("args, expected", [
+        ("добавить событие 10.10.2025 встреча с клиентом", ("встреча с клиентом", "10.10.2025")),
+        ("Добавить событие завтра совещание", ("совещание", "завтра")),
+        ("добавить событие сегодня", None),
+    ])
+    async def test_calendar_arguments(self, args, expected):
+        """Test that the date is the third word and the title is everything after it"""
+        bot, update, context = self.make_call(args.split())
+        create = AsyncMock(return_value={'success': True, 'summary': 's', 'date': 'd', 'link': ''})
+
+        with patch('tools.create_calendar_event', create):
+            await bot.calendar_command(update, context)
+
+        if expected is None:
+            create.assert_not_called()
+            assert "Формат" in update.message.reply_text.await_args.args[0]
+        else:
+            create.assert_awaited_once_with(*expected)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("args, expected, reply", [
+        ("отправить boss@company.com: отчет готов", ("boss@company.com", "отчет готов"), "Email отправлен"),
+        ("отправить a.b@mail.ru:тема: с двоеточием", ("a.b@mail.ru", "тема: с двоеточием"), "Email отправлен"),
+        ("отправить boss@company.com отчет", None, "Формат"),
+        ("отправить boss: отчет", None, "Неверный формат email"),
+    ])
+    async def test_email_arguments(self, args, expected, reply):
+        """Test that the address comes before the first colon and the subject after it"""
+        bot, update, context = self.make_call(args.split())
+        update.effective_user.id = 1
+        send = AsyncMock(return_value={'success': True, 'to': 't', 'subject': 's', 'timestamp': 'ts'})
+
+        with patch('tools.send_email_notification', send):
+            await bot.email_command(update, context)
+
+        if expected is None:
+            send.assert_not_called()
+        else:
+            assert send.await_args.args[:2] == expected
+        assert reply in update.message.reply_text.await_args.args[0]
+
+class TestKeywordRouting:
+    """Test cases for keyword routing of MCP help and fallback replies"""
+
+    @pytest.mark.parametrize("message, expected", [
+        *[(f"{keyword} на завтра", "mcp_calendar")
+          for keyword in ("календарь", "calendar", "событие", "встреча", "напоминание")],
+        *[(f"нужно {keyword}", "mcp_email")
+          for keyword in ("email", "почта", "письмо", "отправить", "уведомление")],
+        *[(f"{keyword} про python", "mcp_search")
+          for keyword in ("поиск", "search", "найти", "информация", "погода", "курс")],
+        # Calendar goes before email, email before search
+        ("встреча и письмо", "mcp_calendar"),
+        ("письмо с поиском", "mcp_email"),
+        ("погода, календарь и почта", "mcp_calendar"),
+        # Keywords match inside longer words
+        ("между встречами", "mcp_calendar"),
+        ("research paper", "mcp_search"),
+        ("как дела", None),
+    ])
+    def test_mcp_routing(self, message, expected):
+        """Test that MCP keywords pick the help of the first matching group"""
+        from agent import _route_reply, _MCP_REPLIES, _MCP_GENERAL_HELP
+
+        replies = dict(_MCP_REPLIES)
+        assert _route_reply(message, _MCP_REPLIES, _MCP_GENERAL_HELP) == replies.get(expected, _MCP_GENERAL_HELP)
+
+    @pytest.mark.parametrize("message, expected", [
+        *[(f"{keyword}!", "greeting") for keyword in ("привет", "hello", "hi", "здравствуй")],
+        *[(f"{keyword} большое", "thanks") for keyword in ("спасибо", "thanks", "thank you")],
+        *[(f"открой {keyword}", "calendar") for keyword in ("календарь", "calendar", "событие")],
+        *[(f"где {keyword}", "email") for keyword in ("email", "почта", "письмо")],
+        *[(f"нужен {keyword}", "search") for keyword in ("поиск", "search", "найти")],
+        # Greeting goes before thanks, thanks before tool hints
+        ("привет и спасибо", "greeting"),
+        ("спасибо за письмо", "thanks"),
+        ("календарь и почта", "calendar"),
+        ("письмо и поиск", "email"),
+        ("что нового", None),
+    ])
+    def test_fallback_routing(self, message, expected):
+        """Test that fallback replies follow the keyword group priority"""
+        from agent import _route_reply, _FALLBACK_REPLIES, _FALLBACK_DEFAULT
+
+        replies = dict(_FALLBACK_REPLIES)
+        assert _route_reply(message, _FALLBACK_REPLIES, _FALLBACK_DEFAULT) == replies.get(expected, _FALLBACK_DEFAULT)
+
+class TestContextCompression:
+    """Test cases for the rolling summary and history trimming"""
+
+    @staticmethod
+    def make_context(count, start=0):
+        """Build alternating user/assistant messages with increasing timestamps"""
+        return [
+            {"role": ("user", "assistant")[i % 2], "content": f"сообщение {i}",
+             "timestamp": f"2025-01-01T00:00:{i:02d}"}
+            for i in range(start, start + count)
+        ]
+
+    @pytest.mark.asyncio
+    async def test_summary_is_rolled_forward(self, make_agent):
+        """Test that the summary is reused until CONTEXT_WINDOW new messages drop out of the window"""
+        from agent import CONTEXT_WINDOW
+
+        agent = make_agent()
+        agent._call_openai_api = AsyncMock(side_effect=["первое резюме", "второе резюме"])
+        older = self.make_context(4)
+
+        assert await agent._get_context_summary(1, older) == "первое резюме"
+        assert await agent._get_context_summary(1, older + self.make_context(CONTEXT_WINDOW - 1, 4)) == "первое резюме"
+        assert agent._call_openai_api.await_count == 1
+
+        assert await agent._get_context_summary(1, older + self.make_context(CONTEXT_WINDOW, 4)) == "второе резюме"
+        dialogue = agent._call_openai_api.call_args.args[0][1]['content']
+        assert dialogue.startswith("Предыдущее краткое содержание: первое резюме")
+        assert "сообщение 3" not in dialogue
+
+    @pytest.mark.asyncio
+    async def test_summaries_are_bounded(self, make_agent):
+        """Test that the least recently used summary is dropped past SUMMARY_CACHE_USERS"""
+        agent = make_agent()
+        agent._call_openai_api = AsyncMock(return_value="резюме")
+
+        with patch('agent.SUMMARY_CACHE_USERS', 2):
+            for user_id in (1, 2):
+                await agent._get_context_summary(user_id, self.make_context(4))
+            await agent._get_context_summary(1, self.make_context(4))
+            await agent._get_context_summary(3, self.make_context(4))
+
+        assert list(agent._summaries) == [1, 3]
+
+    def test_history_is_trimmed_to_token_budget(self, make_agent):
+        """Test that only the newest messages fitting the token budget are kept"""
+        agent = make_agent()
+        context = self.make_context(6)
+
+        with patch('agent.CONTEXT_TOKEN_BUDGET', 5), \
+             patch('agent._count_tokens', lambda text, model: len(text.split())):
+            assert agent._get_context_start(context, len(context), "вопрос") == 4
+            assert agent._get_context_start(context, 1, "вопрос") == 5
+
+        assert agent._get_context_start(context, len(context), "вопрос") == 0
+
+
+class TestStreamingReply:
+    """Test cases for streaming LLM replies into Telegram"""
+
+    @staticmethod
+    def make_bot():
+        """Build a bot without running its constructor"""
+        from main import TelegramAgentBot
+
+        bot = TelegramAgentBot.__new__(TelegramAgentBot)
+        bot._search_knowledge = Mock(return_value=[])
+        return bot
+
+    @staticmethod
+    def make_update():
+        """Build an update whose reply message records edits"""
+        update = Mock()
+        reply = Mock()
+        reply.edit_text = AsyncMock()
+        update.message.reply_text = AsyncMock(return_value=reply)
+        return update, reply
+
+    @pytest.mark.asyncio
+    async def test_reply_is_edited_as_chunks_arrive(self):
+        """Test that the reply is sent once and edited only when its text changes"""
+        async def stream(*args):
+            for chunk in [" ", "При", "вет", "", "!", " "]:
+                yield chunk
+
+        bot = self.make_bot()
+        update, reply = self.make_update()
+        with patch('main.generate_response_stream', stream), patch('main.STREAM_EDIT_INTERVAL', 0):
+            response = await bot._reply_with_stream(update, 1, "привет", [])
+
+        assert response == "Привет!"
+        update.message.reply_text.assert_awaited_once_with("При")
+        assert [call.args[0] for call in reply.edit_text.await_args_list] == ["Привет", "Привет!"]
+
+    @pytest.mark.asyncio
+    async def test_throttled_edits_end_with_full_text(self):
+        """Test that edits skipped by the throttle are caught up by one final edit"""
+        async def stream(*args):
+            for chunk in ["Один", " два", " три"]:
+                yield chunk
+
+        bot = self.make_bot()
+        update, reply = self.make_update()
+        with patch('main.generate_response_stream', stream), patch('main.STREAM_EDIT_INTERVAL', 3600):
+            response = await bot._reply_with_stream(update, 1, "считай", [])
+
+        assert response == "Один два три"
+        update.message.reply_text.assert_awaited_once_with("Один")
+        reply.edit_text.assert_awaited_once_with("Один два три")
+
+class TestMCPTriage:
+    """Test cases for routing MCP keyword messages"""
+
+    @pytest.mark.asyncio
+    async def test_command_skips_classifier(self, make_agent):
+        """Test that a message naming a tool is answered without the triage model"""
+        from agent import _MCP_CALENDAR_HELP
+
+        agent = make_agent()
+        agent._classify_intent = AsyncMock()
+
+        assert await agent._triage_mcp_request("покажи календарь", [], []) == _MCP_CALENDAR_HELP
+        agent._classify_intent.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_ambiguous_keyword_is_classified(self, make_agent):
+        """Test that an ambiguous keyword goes to the main model when triage says CHAT"""
+        agent = make_agent()
+        agent._call_openai_api = AsyncMock(return_value="CHAT")
+
+        assert await agent._triage_mcp_request("какой курс лучше выбрать", [], []) is None
+        agent._call_openai_api.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_classifier_failure_falls_back_to_keywords(self, make_agent):
+        """Test that a failed triage call routes the message by its keywords"""
+        from agent import _MCP_SEARCH_HELP
+
+        agent = make_agent()
+        agent._call_openai_api = AsyncMock(side_effect=RuntimeError("triage down"))
+
+        assert await agent._triage_mcp_request("какая погода завтра", [], []) == _MCP_SEARCH_HELP
+        assert agent.intent_cache.get_stats()['size'] == 0
+
+class TestPerChatUpdateProcessor:
+    """Test cases for per-chat update serialization"""
+
+    @staticmethod
+    def make_update(chat_id):
+        """Build a fake update from the given chat"""
+        from telegram import Update
+
+        update = Mock(spec=Update)
+        update.effective_chat.id = chat_id
+        return update
+
+    @staticmethod
+    def make_handler(events):
+        """Build a handler that records when each update starts and ends"""
+        async def handle(name):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+        return handle
+
+    @pytest.mark.asyncio
+    async def test_serializes_within_chat_only(self):
+        """Test that updates of one chat run in order while other chats run alongside"""
+        from main import PerChatUpdateProcessor
+
+        processor = PerChatUpdateProcessor(8)
+        events = []
+        handle = self.make_handler(events)
+
+        await asyncio.gather(
+            processor.process_update(self.make_update(1), handle("a1")),
+            processor.process_update(self.make_update(1), handle("a2")),
+            processor.process_update(self.make_update(2), handle("b1")),
+        )
+
+        assert events.index("a1 end") < events.index("a2 start")
+        assert events.index("b1 start") < events.index("a1 end")
+        assert processor._chat_locks == {}
+
+    @pytest.mark.asyncio
+    async def test_chat_backlog_does_not_take_slots(self):
+        """Test that updates queued behind their own chat leave the slot to other chats"""
+        from main import PerChatUpdateProcessor
+
+        processor = PerChatUpdateProcessor(1)
+        events = []
+        handle = self.make_handler(events)
+
+        await asyncio.gather(
+            processor.process_update(self.make_update(1), handle("a1")),
+            processor.process_update(self.make_update(1), handle("a2")),
+            processor.process_update(self.make_update(1), handle("a3")),
+            processor.process_update(self.make_update(2), handle("b1")),
+        )
+
+        assert processor.max_concurrent_updates == 1
+        assert events[:4] == ["a1 start", "a1 end", "b1 start", "b1 end"]
+
+
+class TestKnowledgeBase:
+    """Test cases for the SQLite knowledge base"""
+
+    @pytest.fixture
+    def kb(self, tmp_path):
+        """Create a knowledge base in a temporary database"""
+        from vector_db import SimpleKnowledgeBase
+
+        kb = SimpleKnowledgeBase(str(tmp_path / "knowledge.db"))
+        yield kb
+        kb.close()
+
+    def test_json_sources_replace_only_their_items(self, kb, tmp_path):
+        """Test that reloading a changed JSON file keeps other files and runtime additions"""
+        a_path, b_path = tmp_path / "a.json", tmp_path / "b.json"
+        a_path.write_text(json.dumps(["alpha one", "alpha two"]))
+        b_path.write_text(json.dumps(["beta one"]))
+
+        assert kb.load_knowledge_from_json(str(a_path))
+        assert kb.load_knowledge_from_json(str(b_path))
+        assert kb.add_knowledge(["gamma runtime"])
+
+        a_path.write_text(json.dumps(["alpha three"]))
+        kb._loaded_paths.clear()
+        assert kb.load_knowledge_from_json(str(a_path))
+
+        texts = {text for text, in kb._conn().execute('SELECT text FROM knowledge')}
+        assert texts == {"alpha three", "beta one", "gamma runtime"}
+        assert kb.get_stats()['total_items'] == 3
+        assert [text for text, _, _ in kb.search("alpha")] == ["alpha three"]
+
+    def test_json_sources_keep_shared_texts(self, kb, tmp_path):
+        """Test that reloading one JSON file keeps a text another file also contains"""
+        a_path, b_path = tmp_path / "a.json", tmp_path / "b.json"
+        a_path.write_text(json.dumps(["shared text", "alpha one"]))
+        b_path.write_text(json.dumps(["shared text"]))
+
+        assert kb.load_knowledge_from_json(str(a_path))
+        assert kb.load_knowledge_from_json(str(b_path))
+
+        a_path.write_text(json.dumps(["alpha two"]))
+        kb._loaded_paths.clear()
+        assert kb.load_knowledge_from_json(str(a_path))
+
+        texts = {text for text, in kb._conn().execute('SELECT text FROM knowledge')}
+        assert texts == {"alpha two", "shared text"}
+
+    def test_search_cache_follows_reload(self, kb, tmp_path):
+        """Test that cached search results are dropped when a JSON file is reloaded"""
+        path = tmp_path / "a.json"
+        path.write_text(json.dumps(["календарь старый"]))
+        assert kb.load_knowledge_from_json(str(path))
+        assert [text for text, _, _ in kb.search("календарь")] == ["календарь старый"]
+
+        path.write_text(json.dumps(["календарь новый"]))
+        kb._loaded_paths.clear()
+        assert kb.load_knowledge_from_json(str(path))
+
+        assert [text for text, _, _ in kb.search("календарь")] == ["календарь новый"]
+
+    def test_duplicates_are_found_by_text_hash(self, kb):
+        """Test that duplicate checks use the hash index and tolerate hash collisions"""
+        indexes = {name for name, in kb._conn().execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert "idx_text_hash" in indexes
+        assert "idx_text" not in indexes
+
+        statements = []
+        kb._conn().set_trace_callback(statements.append)
+        assert kb.add_knowledge(["повтор", "повтор", "другой"])
+        kb._conn().set_trace_callback(None)
+
+        # The trace holds the duplicate check with its parameters filled in
+        check = next(sql for sql in statements if "text_hash IN" in sql)
+        plan = " ".join(row[-1] for row in kb._conn().execute(f"EXPLAIN QUERY PLAN {check}"))
+        assert "idx_text_hash" in plan
+
+        assert kb.add_knowledge(["повтор"])
+        with patch('vector_db._text_hash', return_value=42):
+            # Colliding hashes only make texts candidates, the texts themselves are compared
+            assert kb.add_knowledge(["коллизия один", "коллизия два"])
+
+        texts = sorted(text for text, in kb._conn().execute('SELECT text FROM knowledge'))
+        assert texts == ["другой", "коллизия два", "коллизия один", "повтор"]
+
+    def test_item_counter_follows_changes(self, tmp_path):
+        """Test that the item counter is seeded on databases without it and kept by triggers"""
+        import sqlite3
+        from vector_db import SimpleKnowledgeBase
+
+        db_path = tmp_path / "knowledge.db"
+        kb = SimpleKnowledgeBase(str(db_path))
+        kb.add_knowledge(["один", "два", "три"])
+        kb.close()
+
+        # A database from before the counter existed
+        conn = sqlite3.connect(db_path)
+        conn.execute("DROP TRIGGER knowledge_count_insert")
+        conn.execute("DROP TRIGGER knowledge_count_delete")
+        conn.execute("DROP TABLE knowledge_stats")
+        conn.commit()
+        conn.close()
+
+        kb = SimpleKnowledgeBase(str(db_path))
+        try:
+            count = lambda: kb._conn().execute('SELECT COUNT(*) FROM knowledge').fetchone()[0]
+            assert kb.get_stats()['total_items'] == count() == 3
+
+            path = tmp_path / "a.json"
+            path.write_text(json.dumps(["четыре", "пять"]))
+            assert kb.load_knowledge_from_json(str(path))
+            assert kb.get_stats()['total_items'] == count() == 5
+
+            path.write_text(json.dumps(["шесть"]))
+            kb._loaded_paths.clear()
+            assert kb.load_knowledge_from_json(str(path))
+            assert kb.get_stats()['total_items'] == count() == 4
+
+            assert kb.clear()
+            assert kb.get_stats()['total_items'] == 0
+        finally:
+            kb.close()
+
+    def test_migrates_baseline_database(self, tmp_path, monkeypatch):
+        """Test that a database from the original schema is deduplicated and replaced on reload"""
+        import sqlite3
+        from vector_db import SimpleKnowledgeBase
+
+        monkeypatch.chdir(tmp_path)
+        db_path = tmp_path / "knowledge.db"
+        conn = sqlite3.connect(db_path)
+        conn.execute('''
+            CREATE TABLE knowledge (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                metadata TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('CREATE INDEX idx_text ON knowledge(text)')
+        # The original version appended knowledge.json again on every start
+        conn.executemany('INSERT INTO knowledge (text) VALUES (?)',
+                         [("old one",), ("old two",), ("old one",), ("old two",)])
+        conn.commit()
+        conn.close()
+
+        kb = SimpleKnowledgeBase(str(db_path))
+        try:
+            rows = kb._conn().execute('SELECT text, source FROM knowledge ORDER BY id').fetchall()
+            source = str((tmp_path / "knowledge.json").resolve())
+            assert rows == [("old one", source), ("old two", source)]
+            assert kb.get_stats()['total_items'] == 2
+
+            (tmp_path / "knowledge.json").write_text(json.dumps(["old one", "new one"]))
+            assert kb.load_knowledge_from_json()
+
+            texts = [text for text, in kb._conn().execute('SELECT text FROM knowledge ORDER BY id')]
+            assert sorted(texts) == ["new one", "old one"]
+            assert kb.get_stats()['total_items'] == 2
+            assert [text for text, _, _ in kb.search("old")] == ["old one"]
+        finally:
+            kb.close()
+
+    @pytest.mark.parametrize("query", [
+        "календарь",
+        "Встреча календарь",
+        "письмо отчет почта",
+        "python search",
+        "нет такого слова",
+    ])
+    def test_search_paths_agree(self, kb, query):
+        """Test that snapshot, FTS and scan search return the same results"""
+        from vector_db import WORD_RE
+
+        if not kb._fts_enabled:
+            pytest.skip("SQLite built without FTS5 trigram tokenizer")
+
+        kb.add_knowledge([
+            "Календарь: создание событий",
+            "Встреча в календаре завтра",
+            "ВСТРЕЧА с командой, календарь обновлен",
+            "Отправить письмо с отчетом",
+            "Почта: письмо и отчет отправлены",
+            "Python search engine",
+            "search",
+            "Напоминание о встрече",
+        ], [{"id": i} for i in range(8)])
+
+        words = WORD_RE.findall(query.lower())
+        top_k = 20
+        by_rank = lambda results: sorted(results, key=lambda r: (-r[1], len(r[0]), r[0]))
+
+        snapshot = kb.search(query, top_k)
+        fts = kb._format_results(kb._search_fts(words, top_k), len(words))
+        scan = kb._format_results(kb._search_scan(words, top_k), len(words))
+        sql = kb._format_results(kb._search_sql(words, top_k), len(words))
+
+        assert kb._snapshot is not None
+        assert by_rank(snapshot) == by_rank(fts) == by_rank(scan) == by_rank(sql)
+        assert [len(text) for text, _, _ in snapshot] == [len(text) for text, _, _ in by_rank(snapshot)]
+
+
+    def test_added_knowledge_replaces_snapshot(self, kb):
+        """Test that adding knowledge swaps in a new snapshot and leaves the old one intact"""
+        kb.add_knowledge(["календарь встреч"])
+        assert [text for text, _, _ in kb.search("календарь")] == ["календарь встреч"]
+        old = kb._snapshot
+        old_terms = {token: list(positions) for token, positions in old[2].items()}
+
+        kb.add_knowledge(["календарь"])
+
+        assert kb._snapshot is not old
+        assert list(old[1]) == list(kb._snapshot[1])[:1]
+        assert {token: list(positions) for token, positions in old[2].items()} == old_terms
+        assert [text for text, _, _ in kb.search("календарь")] == ["календарь", "календарь встреч"]
+
+    def test_match_positions_finds_substrings(self, kb):
+        """Test that the n-gram lookup finds the same texts as checking every token"""
+        texts = ["Встреча в календаре", "календарь", "встречи нет", "в", "Python search", "research"]
+        kb.add_knowledge(texts)
+        snapshot = kb._get_snapshot()
+
+        for word in ["в", "ка", "вст", "встреч", "ндар", "search", "rch", "нет", "xyz", "календарное"]:
+            expected = {position for position, text in enumerate(texts) if word in text.lower()}
+            assert kb._match_positions(snapshot, word) == expected, word
+
+class TestConversationMemory:
+    """Test cases for conversation memory storage"""
+
+    def test_migrates_blob_histories(self, tmp_path):
+        """Test that JSON blob histories move to message rows, trimmed, skipping corrupt and malformed rows"""
+        import sqlite3
+        from memory import ConversationMemory
+
+        db_path = tmp_path / "memory.db"
+        conn = sqlite3.connect(db_path)
+        conn.execute("""
+            CREATE TABLE conversations (
+                user_id INTEGER PRIMARY KEY,
+                session_history TEXT NOT NULL DEFAULT '[]',
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        long_history = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i}", "timestamp": f"t{i}"}
+            for i in range(15)
+        ]
+        conn.executemany("INSERT INTO conversations (user_id, session_history) VALUES (?, ?)", [
+            (1, json.dumps(long_history)),
+            (2, "{not json"),
+            (3, json.dumps([{"role": "user", "content": "привет"}, "not a message"])),
+            (4, json.dumps({"role": "user", "content": "not a list"})),
+        ])
+        conn.commit()
+        conn.close()
+
+        memory = ConversationMemory(str(db_path))
+        try:
+            context = memory.get_context(1)
+            assert len(context) == memory.max_messages
+            assert [entry["content"] for entry in context] == [f"m{i}" for i in range(5, 15)]
+            assert context[0] == {"role": "assistant", "content": "m5", "timestamp": "t5"}
+
+            assert memory.get_context(2) == []
+
+            migrated = memory.get_context(3)
+            assert [(entry["role"], entry["content"]) for entry in migrated] == [("user", "привет")]
+            assert migrated[0]["timestamp"]
+
+            assert memory.get_context(4) == []
+
+            tables = {name for name, in memory._conn().execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            assert "conversations" not in tables
+        finally:
+            memory.close()
+
+
 class TestIntegration:
     """Integration tests"""
     
@@ -259,6 +1111,40 @@ class TestIntegration:
             assert 'gmail' in result
             assert 'search' in result
 
+    @pytest.mark.asyncio
+    async def test_all_mcp_health_check_isolates_failures(self):
+        """Test that one failing probe does not hide the other results"""
+        import tools
+
+        with patch.object(tools.mcp_tools, 'check_calendar_health', side_effect=RuntimeError("boom")), \
+             patch.object(tools.mcp_tools, 'check_gmail_health', return_value={'status': 'healthy'}), \
+             patch.object(tools.mcp_tools, 'check_search_health', return_value={'status': 'healthy'}):
+            result = await tools.check_all_mcp_health()
+
+        assert result['calendar'] == {'status': 'error', 'error': 'boom'}
+        assert result['gmail']['status'] == 'healthy'
+        assert result['search']['status'] == 'healthy'
+
+
+    @pytest.mark.asyncio
+    async def test_all_mcp_health_check_reports_each_failure(self):
+        """Test that several failing probes each get their own error next to a healthy one"""
+        import tools
+
+        async def slow_gmail():
+            # Finishes last, so the other failures have already happened
+            await asyncio.sleep(0.01)
+            return {'status': 'healthy'}
+
+        with patch.object(tools.mcp_tools, 'check_calendar_health', side_effect=RuntimeError("calendar down")), \
+             patch.object(tools.mcp_tools, 'check_gmail_health', side_effect=slow_gmail), \
+             patch.object(tools.mcp_tools, 'check_search_health', side_effect=ConnectionError("search down")):
+            result = await tools.check_all_mcp_health()
+
+        assert list(result) == ['calendar', 'gmail', 'search']
+        assert result['calendar'] == {'status': 'error', 'error': 'calendar down'}
+        assert result['gmail'] == {'status': 'healthy'}
+        assert result['search'] == {'status': 'error', 'error': 'search down'}
 
 if __name__ == "__main__":
     # Run tests
@@ -8,7 +8,10 @@ import os
 import json
 import logging
 import asyncio
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Any, Optional, Tuple
 import re
 
@@ -18,7 +21,9 @@ try:
     from google_auth_oauthlib.flow import InstalledAppFlow
     from googleapiclient.discovery import build
     from googleapiclient.errors import HttpError
-    import requests
+    import google_auth_httplib2
+    import httplib2
+    import aiohttp
 except ImportError as e:
     logging.error(f"Required packages not installed: {e}")
     raise
@@ -31,6 +36,32 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.send'
 ]
 
+# OAuth token file and how long before expiry the token is refreshed in background
+TOKEN_PATH = 'token.json'
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_DELAY = 60
+
+# Relative dates as day offsets and absolute date formats accepted by _parse_date
+RELATIVE_DAYS = {'сегодня': 0, 'today': 0, 'завтра': 1, 'tomorrow': 1}
+DATE_FORMATS = (
+    (re.compile(r'\d{1,2}\.\d{1,2}\.\d{4}$'), '%d.%m.%Y'),
+    (re.compile(r'\d{4}-\d{1,2}-\d{1,2}$'), '%Y-%m-%d'),
+)
+
+# DuckDuckGo Instant Answer API
+SEARCH_URL = "https://api.duckduckgo.com/"
+SEARCH_TIMEOUT = 10
+
+# Successful searches are reused for SEARCH_CACHE_TTL seconds, including the health probe query
+SEARCH_CACHE_TTL = 30
+SEARCH_CACHE_SIZE = 128
+
+# Socket timeout for Google API calls
+GOOGLE_HTTP_TIMEOUT = 30
+
+# Calls per multipart batch request; Calendar and Gmail recommend at most 50
+GOOGLE_BATCH_SIZE = 50
+
 class MCPTools:
     """MCP (Model Context Protocol) Tools for Calendar, Gmail, and Web Search"""
     
@@ -39,6 +70,20 @@ class MCPTools:
         self.gmail_service = None
         self.credentials = None
         
+        # Per-thread authorized HTTP clients: httplib2 is not thread-safe, but each
+        # client keeps its connections alive between calls made from its thread
+        self._local = threading.local()
+        
+        # Access token last written to token.json and the task renewing it before expiry
+        self._saved_token: Optional[str] = None
+        self._token_task: Optional[asyncio.Task] = None
+        
+        # Shared HTTP session for web search, created inside the running event loop
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        
+        # LRU of (query, max_results) -> (expires, result)
+        self._search_cache: OrderedDict[Tuple[str, int], Tuple[float, Dict[str, Any]]] = OrderedDict()
+        
         # Initialize Google services
         self._initialize_google_services()
     
@@ -72,11 +117,11 @@ class MCPTools:
         """Get Google API credentials"""
         try:
             creds = None
-            token_path = 'token.json'
             
             # Load existing token
-            if os.path.exists(token_path):
-                creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+            if os.path.exists(TOKEN_PATH):
+                creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+                self._saved_token = creds.token
             
             # If no valid credentials, request authorization
             if not creds or not creds.valid:
@@ -88,8 +133,7 @@ class MCPTools:
                     creds = flow.run_local_server(port=0)
                 
                 # Save credentials for next run
-                with open(token_path, 'w') as token:
-                    token.write(creds.to_json())
+                self._save_token(creds)
             
             return creds
             
@@ -97,6 +141,43 @@ class MCPTools:
             logger.error(f"Error getting Google credentials: {e}")
             return None
     
+    def _save_token(self, creds: Credentials):
+        """Write token.json atomically, skipping the write when the token did not change"""
+        if creds.token == self._saved_token:
+            return
+        
+        tmp_path = TOKEN_PATH + '.tmp'
+        with open(tmp_path, 'w') as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, TOKEN_PATH)
+        self._saved_token = creds.token
+    
+    def _ensure_token_refresher(self):
+        """Start background token refresh on first Google API use inside the event loop"""
+        if self._token_task is None and self.credentials and self.credentials.refresh_token:
+            self._token_task = asyncio.create_task(self._token_refresher())
+    
+    async def _token_refresher(self):
+        """Refresh OAuth token TOKEN_REFRESH_MARGIN seconds before it expires, so API calls never wait for it"""
+        while True:
+            expiry = self.credentials.expiry
+            if expiry is None:
+                return
+            
+            # google-auth keeps expiry as naive UTC; compared as an aware datetime
+            if expiry.tzinfo is None:
+                expiry = expiry.replace(tzinfo=timezone.utc)
+            delay = (expiry - datetime.now(timezone.utc)).total_seconds() - TOKEN_REFRESH_MARGIN
+            await asyncio.sleep(max(delay, 0))
+            
+            try:
+                await asyncio.to_thread(self.credentials.refresh, Request())
+                await asyncio.to_thread(self._save_token, self.credentials)
+                logger.info("Google OAuth token refreshed")
+            except Exception as e:
+                logger.error(f"Google OAuth token refresh failed: {e}")
+                await asyncio.sleep(TOKEN_RETRY_DELAY)
+    
     # Google Calendar Methods
     async def create_event(self, summary: str, date_str: str) -> Dict[str, Any]:
         """
@@ -115,6 +196,7 @@ class MCPTools:
                     'success': False,
                     'error': 'Google Calendar service not initialized'
                 }
+            self._ensure_token_refresher()
             
             # Parse date
             event_date = self._parse_date(date_str)
@@ -124,34 +206,15 @@ class MCPTools:
                     'error': f'Invalid date format: {date_str}'
                 }
             
-            # Create event
-            event = {
-                'summary': summary,
-                'start': {
-                    'dateTime': event_date.isoformat(),
-                    'timeZone': 'Europe/Moscow',
-                },
-                'end': {
-                    'dateTime': (event_date + timedelta(hours=1)).isoformat(),
-                    'timeZone': 'Europe/Moscow',
-                },
-                'description': f'Created by Telegram Agent Bot on {datetime.now().strftime("%Y-%m-%d %H:%M")}'
-            }
-            
-            # Insert event
-            created_event = self.calendar_service.events().insert(
-                calendarId='primary', body=event
-            ).execute()
+            # Insert event; execute() blocks on HTTPS, so run it off the event loop
+            request = self.calendar_service.events().insert(
+                calendarId='primary', body=self._build_event(summary, event_date)
+            )
+            created_event = await asyncio.to_thread(self._execute, request)
             
             logger.info(f"Created calendar event: {summary} on {event_date}")
             
-            return {
-                'success': True,
-                'event_id': created_event['id'],
-                'summary': summary,
-                'date': event_date.strftime('%Y-%m-%d %H:%M'),
-                'link': created_event.get('htmlLink', '')
-            }
+            return self._event_result(created_event, summary, event_date)
             
         except HttpError as e:
             logger.error(f"Google Calendar API error: {e}")
@@ -166,26 +229,139 @@ class MCPTools:
                 'error': f'Error creating event: {str(e)}'
             }
     
+    async def create_events_batch(self, events: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """
+        Create several calendar events with one batched HTTP request
+        
+        Args:
+            events: List of (summary, date_str) pairs
+            
+        Returns:
+            List of result dicts in the same order and format as create_event
+        """
+        if not self.calendar_service:
+            return [{'success': False, 'error': 'Google Calendar service not initialized'} for _ in events]
+        self._ensure_token_refresher()
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(events)
+        pending = []
+        for i, (summary, date_str) in enumerate(events):
+            event_date = self._parse_date(date_str)
+            if event_date:
+                pending.append((i, summary, event_date))
+            else:
+                results[i] = {'success': False, 'error': f'Invalid date format: {date_str}'}
+        
+        if not pending:
+            return results
+        
+        try:
+            api_requests = [
+                self.calendar_service.events().insert(
+                    calendarId='primary', body=self._build_event(summary, event_date)
+                )
+                for _, summary, event_date in pending
+            ]
+            responses = await asyncio.to_thread(self._execute_batch, self.calendar_service, api_requests)
+        except Exception as e:
+            logger.error(f"Error creating calendar events batch: {e}")
+            for i, _, _ in pending:
+                results[i] = {'success': False, 'error': f'Error creating event: {str(e)}'}
+            return results
+        
+        for (i, summary, event_date), (exception, created_event) in zip(pending, responses):
+            if exception is not None:
+                logger.error(f"Google Calendar API error: {exception}")
+                results[i] = {'success': False, 'error': f'Calendar API error: {str(exception)}'}
+            else:
+                results[i] = self._event_result(created_event, summary, event_date)
+        
+        logger.info(f"Created {len(pending)} calendar events in batch")
+        return results
+    
+    def _build_event(self, summary: str, event_date: datetime) -> Dict[str, Any]:
+        """Build one-hour Calendar API event body starting at event_date"""
+        return {
+            'summary': summary,
+            'start': {
+                'dateTime': event_date.isoformat(),
+                'timeZone': 'Europe/Moscow',
+            },
+            'end': {
+                'dateTime': (event_date + timedelta(hours=1)).isoformat(),
+                'timeZone': 'Europe/Moscow',
+            },
+            'description': f'Created by Telegram Agent Bot on {datetime.now().strftime("%Y-%m-%d %H:%M")}'
+        }
+    
+    def _event_result(self, created_event: Dict[str, Any], summary: str, event_date: datetime) -> Dict[str, Any]:
+        """Build create_event result from Calendar API response"""
+        return {
+            'success': True,
+            'event_id': created_event['id'],
+            'summary': summary,
+            'date': event_date.strftime('%Y-%m-%d %H:%M'),
+            'link': created_event.get('htmlLink', '')
+        }
+    
+    def _thread_http(self) -> google_auth_httplib2.AuthorizedHttp:
+        """Get authorized HTTP client of the current thread, reusing its TLS connections"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+            )
+            self._local.http = http
+        return http
+    
+    def _execute(self, request) -> Any:
+        """Execute API request with the current thread's HTTP client; call from a worker thread"""
+        return request.execute(http=self._thread_http())
+    
+    def _execute_batch(self, service, api_requests: List[Any]) -> List[Tuple[Optional[Exception], Any]]:
+        """
+        Execute API requests as multipart batches of GOOGLE_BATCH_SIZE calls
+        
+        Args:
+            service: Google API service the requests belong to
+            api_requests: Unexecuted API requests
+            
+        Returns:
+            List of (exception, response) pairs in request order
+        """
+        responses = {}
+        
+        def callback(request_id, response, exception):
+            responses[request_id] = (exception, response)
+        
+        for start in range(0, len(api_requests), GOOGLE_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for i, request in enumerate(api_requests[start:start + GOOGLE_BATCH_SIZE], start):
+                batch.add(request, request_id=str(i))
+            batch.execute(http=self._thread_http())
+        
+        return [responses[str(i)] for i in range(len(api_requests))]
+    
     def _parse_date(self, date_str: str) -> Optional[datetime]:
         """Parse date string to datetime object"""
         try:
             date_str = date_str.lower().strip()
             
             # Handle relative dates
-            if date_str in ['сегодня', 'today']:
-                return datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
-            elif date_str in ['завтра', 'tomorrow']:
-                return (datetime.now() + timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0)
-            
-            # Handle DD.MM.YYYY format
-            if re.match(r'\d{1,2}\.\d{1,2}\.\d{4}', date_str):
-                return datetime.strptime(date_str, '%d.%m.%Y').replace(hour=9, minute=0, second=0, microsecond=0)
-            
-            # Handle YYYY-MM-DD format
-            if re.match(r'\d{4}-\d{1,2}-\d{1,2}', date_str):
-                return datetime.strptime(date_str, '%Y-%m-%d').replace(hour=9, minute=0, second=0, microsecond=0)
+            days = RELATIVE_DAYS.get(date_str)
+            if days is not None:
+                date = datetime.now() + timedelta(days=days)
+            else:
+                # Handle DD.MM.YYYY and YYYY-MM-DD formats
+                for pattern, date_format in DATE_FORMATS:
+                    if pattern.match(date_str):
+                        date = datetime.strptime(date_str, date_format)
+                        break
+                else:
+                    return None
             
-            return None
+            # Events start at 9:00
+            return date.replace(hour=9, minute=0, second=0, microsecond=0)
             
         except Exception as e:
             logger.error(f"Error parsing date '{date_str}': {e}")
@@ -210,14 +386,16 @@ class MCPTools:
                     'success': False,
                     'error': 'Gmail service not initialized'
                 }
+            self._ensure_token_refresher()
             
             # Create email message
             message = self._create_email_message(to, subject, body)
             
-            # Send email
-            sent_message = self.gmail_service.users().messages().send(
+            # Send email off the event loop
+            request = self.gmail_service.users().messages().send(
                 userId='me', body=message
-            ).execute()
+            )
+            sent_message = await asyncio.to_thread(self._execute, request)
             
             logger.info(f"Sent email to {to}: {subject}")
             
@@ -242,6 +420,53 @@ class MCPTools:
                 'error': f'Error sending email: {str(e)}'
             }
     
+    async def send_emails_batch(self, emails: List[Tuple[str, str, str]]) -> List[Dict[str, Any]]:
+        """
+        Send several emails with one batched HTTP request
+        
+        Args:
+            emails: List of (to, subject, body) tuples
+            
+        Returns:
+            List of result dicts in the same order and format as send_email
+        """
+        if not self.gmail_service:
+            return [{'success': False, 'error': 'Gmail service not initialized'} for _ in emails]
+        self._ensure_token_refresher()
+        
+        if not emails:
+            return []
+        
+        try:
+            api_requests = [
+                self.gmail_service.users().messages().send(
+                    userId='me', body=self._create_email_message(to, subject, body)
+                )
+                for to, subject, body in emails
+            ]
+            responses = await asyncio.to_thread(self._execute_batch, self.gmail_service, api_requests)
+        except Exception as e:
+            logger.error(f"Error sending email batch: {e}")
+            return [{'success': False, 'error': f'Error sending email: {str(e)}'} for _ in emails]
+        
+        results = []
+        timestamp = datetime.now().isoformat()
+        for (to, subject, _), (exception, sent_message) in zip(emails, responses):
+            if exception is not None:
+                logger.error(f"Gmail API error: {exception}")
+                results.append({'success': False, 'error': f'Gmail API error: {str(exception)}'})
+            else:
+                results.append({
+                    'success': True,
+                    'message_id': sent_message['id'],
+                    'to': to,
+                    'subject': subject,
+                    'timestamp': timestamp
+                })
+        
+        logger.info(f"Sent {len(emails)} emails in batch")
+        return results
+    
     def _create_email_message(self, to: str, subject: str, body: str) -> Dict[str, str]:
         """Create email message for Gmail API"""
         import base64
@@ -268,9 +493,13 @@ class MCPTools:
         Returns:
             Dict with search results
         """
+        cache_key = (query, max_results)
+        cached = self._search_cache.get(cache_key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._search_cache.move_to_end(cache_key)
+            return cached[1]
+        
         try:
-            # DuckDuckGo Instant Answer API
-            url = "https://api.duckduckgo.com/"
             params = {
                 'q': query,
                 'format': 'json',
@@ -278,46 +507,53 @@ class MCPTools:
                 'skip_disambig': '1'
             }
             
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
+            async with self._get_http_session().get(SEARCH_URL, params=params) as response:
+                response.raise_for_status()
+                # DuckDuckGo serves JSON as application/x-javascript
+                data = await response.json(content_type=None)
             
             # Extract results
             results = []
             
             # Abstract (main answer)
-            if data.get('Abstract'):
+            abstract = data.get('Abstract')
+            if abstract and max_results > 0:
                 results.append({
                     'title': data.get('Heading', 'Answer'),
-                    'snippet': data.get('Abstract', ''),
+                    'snippet': abstract,
                     'url': data.get('AbstractURL', ''),
                     'type': 'abstract'
                 })
             
-            # Related topics
-            for topic in data.get('RelatedTopics', [])[:max_results-1]:
-                if isinstance(topic, dict) and topic.get('Text'):
+            # Related topics, stopping once max_results is reached
+            for topic in (data.get('RelatedTopics') or [])[:max_results - 1]:
+                if len(results) >= max_results:
+                    break
+                text = topic.get('Text') if isinstance(topic, dict) else None
+                if text:
+                    first_url = topic.get('FirstURL') or ''
                     results.append({
-                        'title': topic.get('FirstURL', '').split('/')[-1] if topic.get('FirstURL') else 'Related Topic',
-                        'snippet': topic.get('Text', ''),
-                        'url': topic.get('FirstURL', ''),
+                        'title': first_url.rsplit('/', 1)[-1] if first_url else 'Related Topic',
+                        'snippet': text,
+                        'url': first_url,
                         'type': 'related'
                     })
             
-            # Limit results
-            results = results[:max_results]
-            
             logger.info(f"Web search for '{query}' returned {len(results)} results")
             
-            return {
+            result = {
                 'success': True,
                 'query': query,
                 'results': results,
                 'total_results': len(results)
             }
+            self._search_cache[cache_key] = (time.monotonic() + SEARCH_CACHE_TTL, result)
+            self._search_cache.move_to_end(cache_key)
+            if len(self._search_cache) > SEARCH_CACHE_SIZE:
+                self._search_cache.popitem(last=False)
+            return result
             
-        except requests.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Web search request error: {e}")
             return {
                 'success': False,
@@ -330,6 +566,28 @@ class MCPTools:
                 'error': f'Search error: {str(e)}'
             }
     
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """Get shared HTTP session, keeping TCP and TLS connections alive between searches"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)
+            )
+        return self._http_session
+    
+    async def aclose(self):
+        """Stop token refresh and close shared HTTP session"""
+        if self._token_task is not None:
+            self._token_task.cancel()
+            try:
+                await self._token_task
+            except asyncio.CancelledError:
+                pass
+            self._token_task = None
+        
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+    
     # Health Check Methods
     async def check_calendar_health(self) -> Dict[str, Any]:
         """Check Google Calendar service health"""
@@ -338,7 +596,7 @@ class MCPTools:
                 return {'status': 'disabled', 'error': 'Service not initialized'}
             
             # Try to list calendars
-            calendar_list = self.calendar_service.calendarList().list().execute()
+            calendar_list = await asyncio.to_thread(self._execute, self.calendar_service.calendarList().list())
             
             return {
                 'status': 'healthy',
@@ -361,7 +619,7 @@ class MCPTools:
                 return {'status': 'disabled', 'error': 'Service not initialized'}
             
             # Try to get profile
-            profile = self.gmail_service.users().getProfile(userId='me').execute()
+            profile = await asyncio.to_thread(self._execute, self.gmail_service.users().getProfile(userId='me'))
             
             return {
                 'status': 'healthy',
@@ -406,34 +664,73 @@ class MCPTools:
             }
 
 
-# Global MCP tools instance
-mcp_tools = MCPTools()
+# Global MCP tools instance, created on first use: construction reads OAuth
+# files and downloads Google API discovery documents
+_mcp_tools: Optional[MCPTools] = None
+
+
+def get_mcp_tools() -> MCPTools:
+    """Get the global MCP tools instance, creating it on first call"""
+    global _mcp_tools
+    if _mcp_tools is None:
+        _mcp_tools = MCPTools()
+    return _mcp_tools
+
+
+def __getattr__(name: str):
+    # Keep `tools.mcp_tools` working without creating the instance at import
+    if name == 'mcp_tools':
+        return get_mcp_tools()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Convenience functions
 async def create_calendar_event(summary: str, date_str: str) -> Dict[str, Any]:
     """Convenience function to create calendar event"""
-    return await mcp_tools.create_event(summary, date_str)
+    return await get_mcp_tools().create_event(summary, date_str)
+
+
+async def create_calendar_events(events: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    """Convenience function to create several calendar events in one batch"""
+    return await get_mcp_tools().create_events_batch(events)
 
 
 async def send_email_notification(to: str, subject: str, body: str) -> Dict[str, Any]:
     """Convenience function to send email"""
-    return await mcp_tools.send_email(to, subject, body)
+    return await get_mcp_tools().send_email(to, subject, body)
+
+
+async def send_email_notifications(emails: List[Tuple[str, str, str]]) -> List[Dict[str, Any]]:
+    """Convenience function to send several emails in one batch"""
+    return await get_mcp_tools().send_emails_batch(emails)
 
 
 async def search_web(query: str, max_results: int = 3) -> Dict[str, Any]:
     """Convenience function to search web"""
-    return await mcp_tools.web_search(query, max_results)
+    return await get_mcp_tools().web_search(query, max_results)
+
+
+async def close_mcp_tools():
+    """Convenience function to release MCP tools network resources"""
+    if _mcp_tools is not None:
+        await _mcp_tools.aclose()
 
 
 async def check_all_mcp_health() -> Dict[str, Any]:
-    """Check health of all MCP tools"""
-    calendar_health = await mcp_tools.check_calendar_health()
-    gmail_health = await mcp_tools.check_gmail_health()
-    search_health = await mcp_tools.check_search_health()
+    """Check health of all MCP tools concurrently"""
+    tools = get_mcp_tools()
+    names = ('calendar', 'gmail', 'search')
+    results = await asyncio.gather(
+        tools.check_calendar_health(),
+        tools.check_gmail_health(),
+        tools.check_search_health(),
+        return_exceptions=True
+    )
     
-    return {
-        'calendar': calendar_health,
-        'gmail': gmail_health,
-        'search': search_health
-    }
+    health = {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            logger.error(f"{name} health check failed: {result}")
+            result = {'status': 'error', 'error': str(result)}
+        health[name] = result
+    return health
@@ -5,14 +5,126 @@
 """
 
 import json
+import hashlib
+import heapq
 import logging
 import re
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional, Iterable, Iterator
 import sqlite3
 
+# Быстрый разбор JSON (опционально)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# Базы знаний до этого размера ищутся по снимку в памяти, большие - через SQL
+IN_MEMORY_SEARCH_LIMIT = 50_000
+
+# Сколько байт файла базы поиск читает через mmap: страницы берутся из кеша ОС без копирования
+READ_MMAP_SIZE = 64 * 1024 * 1024
+
+# Настройки, применяемые один раз при открытии соединения потока
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA mmap_size={READ_MMAP_SIZE}",
+)
+
+WORD_RE = re.compile(r'\w+')
+
+# Триграммный индекс находит только подстроки от 3 символов
+FTS_MIN_WORD_LENGTH = 3
+
+# Запросы из одного слова: готовый текст SQL, одинаковый для всех вызовов,
+# поэтому SQLite берет скомпилированный запрос из кеша соединения
+SINGLE_WORD_FTS_SQL = '''
+    SELECT text, metadata, 1 FROM knowledge
+    WHERE id IN (SELECT rowid FROM knowledge_fts WHERE knowledge_fts MATCH ?)
+    ORDER BY text_len ASC
+    LIMIT ?
+'''
+SINGLE_WORD_SCAN_SQL = '''
+    SELECT text, metadata, 1 FROM knowledge
+    WHERE INSTR(text_lower, ?) > 0
+    ORDER BY text_len ASC
+    LIMIT ?
+'''
+
+# Сколько текстов проверяется на дубликаты одним запросом (лимит параметров SQLite)
+DUPLICATE_CHECK_CHUNK = 500
+
+# Сколько последних результатов поиска хранится в памяти
+SEARCH_CACHE_SIZE = 1024
+
+# Снимок базы в памяти: (длины текстов, id, токен -> позиции текстов в снимке,
+# словарь токенов списком, n-грамма -> номера токенов в этом списке)
+Snapshot = Tuple[array, array, Dict[str, array], List[str], Dict[str, array]]
+
+# Длина n-грамм словаря токенов: слово не длиннее ищется прямо по n-грамме,
+# у более длинного проверяются только токены с его самой редкой триграммой
+VOCABULARY_GRAM_LENGTH = 3
+
+# Так хранились пустые метаданные до перехода на NULL; при выдаче результатов их не нужно разбирать
+EMPTY_META_JSON = '{}'
+
+def _text_hash(text: str) -> int:
+    """8-байтный хеш текста для индекса проверки дубликатов (знаковый, как INTEGER в SQLite)"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def _query_words(query: str) -> List[str]:
+    """Слова запроса без повторов в порядке появления: повтор не добавляет очков и условий в SQL"""
+    return list(dict.fromkeys(WORD_RE.findall(query.lower())))
+
+
+# Тексты SQL запросов по числу слов: строка собирается один раз, а одинаковый текст
+# позволяет SQLite брать скомпилированный запрос из кеша соединения
+_FTS_SQL_CACHE: Dict[int, str] = {}
+_SCAN_SQL_CACHE: Dict[int, str] = {}
+
+
+def _fts_sql(words_count: int) -> str:
+    """Запрос через триграммный индекс: параметры - фразы слов, их OR и top_k"""
+    sql = _FTS_SQL_CACHE.get(words_count)
+    if sql is None:
+        match_sql = 'SELECT rowid FROM knowledge_fts WHERE knowledge_fts MATCH ?'
+        sql = _FTS_SQL_CACHE[words_count] = f'''
+            SELECT text, metadata,
+                   ({" + ".join([f"CASE WHEN id IN ({match_sql}) THEN 1 ELSE 0 END"] * words_count)}) as score
+            FROM knowledge
+            WHERE id IN ({match_sql})
+            ORDER BY score DESC, text_len ASC
+            LIMIT ?
+        '''
+    return sql
+
+
+def _scan_sql(words_count: int) -> str:
+    """Запрос полным просмотром: параметры - слова и top_k"""
+    sql = _SCAN_SQL_CACHE.get(words_count)
+    if sql is None:
+        # Нумерованные параметры: каждое слово связывается один раз и для фильтра, и для оценки
+        conditions = [f"INSTR(text_lower, ?{i}) > 0" for i in range(1, words_count + 1)]
+        sql = _SCAN_SQL_CACHE[words_count] = f'''
+            SELECT text, metadata, 
+                   ({" + ".join([f"CASE WHEN {condition} THEN 1 ELSE 0 END" for condition in conditions])}) as score
+            FROM knowledge 
+            WHERE {" OR ".join(conditions)}
+            ORDER BY score DESC, text_len ASC
+            LIMIT ?{words_count + 1}
+        '''
+    return sql
+
+
 class SimpleKnowledgeBase:
     """Простая база знаний на основе текстового поиска"""
     
@@ -22,8 +134,33 @@ class SimpleKnowledgeBase:
         data_dir.mkdir(exist_ok=True)
         
         self.db_path = data_dir / db_path
+        # Строка пути для sqlite3.connect, чтобы не преобразовывать Path при каждом подключении
+        self._db_str = str(self.db_path)
         self.knowledge_path = Path("knowledge.json")
         
+        # Снимок (длины текстов, id, словарь токенов) строится при первом поиске; длины и id
+        # лежат в компактных массивах, словарь токенов: токен -> позиции текстов в снимке.
+        # Сами тексты не хранятся - для сравнения достаточно словаря токенов.
+        # Снимок не изменяется после построения: новый снимок заменяет старый одним
+        # присваиванием, поэтому поиск в других потоках видит целый снимок без блокировок
+        self._snapshot: Optional[Snapshot] = None
+        self._snapshot_loaded = False
+        
+        # JSON файлы, уже загруженные этим процессом
+        self._loaded_paths = set()
+        
+        # LRU кеш результатов поиска: (слова запроса, top_k) -> результаты;
+        # поколение растет при каждом изменении базы, чтобы поиск, начатый до
+        # изменения, не положил в кеш устаревший результат
+        self._search_cache: OrderedDict[Tuple[Tuple[str, ...], int], List[Tuple[str, float, Dict[str, Any]]]] = OrderedDict()
+        self._search_cache_lock = threading.Lock()
+        self._search_cache_generation = 0
+        
+        # Постоянное соединение на поток вместо нового подключения на каждый вызов
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        
         # Инициализация SQLite базы данных
         self._init_database()
         
@@ -32,32 +169,205 @@ class SimpleKnowledgeBase:
     def _init_database(self):
         """Инициализация SQLite базы данных"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            # WAL сохраняется в файле базы, достаточно включить один раз
+            self._conn().execute("PRAGMA journal_mode=WAL")
+            
+            with self._transaction() as cursor:
+                # Создание таблицы знаний
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS knowledge (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        text TEXT NOT NULL,
+                        metadata TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        text_lower TEXT,
+                        text_len INTEGER,
+                        text_hash INTEGER,
+                        source TEXT
+                    )
+                ''')
+                
+                # Хеши загруженных JSON файлов, чтобы не загружать их повторно
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS knowledge_sources (
+                        path TEXT PRIMARY KEY,
+                        content_hash TEXT NOT NULL,
+                        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                self._migrate_columns(cursor)
+                
+                # Индекс по полному тексту не помогает поиску подстрок, а проверку дубликатов
+                # обслуживает индекс по 8-байтному хешу текста - он меньше и дешевле при вставке
+                cursor.execute('DROP INDEX IF EXISTS idx_text')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_text_hash ON knowledge(text_hash)
+                ''')
+                
+                # Записи JSON файла заменяются при его изменении, не затрагивая другие знания
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_source ON knowledge(source)
+                ''')
+                
+                # Триграммный FTS5 индекс для поиска подстрок в больших базах
+                self._fts_enabled = self._init_fts(cursor)
+                
+                # Счетчик знаний, чтобы не считать COUNT(*) по всей таблице
+                self._init_counter(cursor)
+            
+            logger.info(f"Database initialized at {self.db_path}")
+            
+        except Exception as e:
+            logger.error(f"Error initializing database: {e}")
+            raise
+    
+    def _conn(self) -> sqlite3.Connection:
+        """Соединение текущего потока; открывается с настройками при первом обращении"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: транзакциями управляет _transaction()
+            conn = sqlite3.connect(
+                self._db_str, timeout=5.0, isolation_level=None, check_same_thread=False
+            )
+            for pragma in _CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    @contextmanager
+    def _cursor(self) -> Iterator[sqlite3.Cursor]:
+        """Курсор для чтения, каждый запрос выполняется в своей неявной транзакции"""
+        cursor = self._conn().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+    
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Курсор внутри транзакции записи: фиксация при успехе, откат при ошибке"""
+        cursor = self._conn().cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        else:
+            cursor.execute("COMMIT")
+        finally:
+            cursor.close()
+    
+    def _migrate_columns(self, cursor: sqlite3.Cursor):
+        """Добавить колонки text_lower, text_len, text_hash и source в базы, созданные до их появления"""
+        cursor.execute('PRAGMA table_info(knowledge)')
+        columns = {column[1] for column in cursor.fetchall()}
+        
+        if 'text_lower' not in columns:
+            cursor.execute('ALTER TABLE knowledge ADD COLUMN text_lower TEXT')
+            # Заполняется через str.lower(): LOWER() в SQLite меняет регистр только у ASCII
+            cursor.execute('SELECT id, text FROM knowledge')
+            updates = [(text.lower(), row_id) for row_id, text in cursor.fetchall()]
+            cursor.executemany('UPDATE knowledge SET text_lower = ? WHERE id = ?', updates)
+            logger.info(f"Added text_lower column to {len(updates)} knowledge items")
+        
+        if 'text_len' not in columns:
+            cursor.execute('ALTER TABLE knowledge ADD COLUMN text_len INTEGER')
+            cursor.execute('UPDATE knowledge SET text_len = LENGTH(text)')
+            logger.info(f"Added text_len column to {cursor.rowcount} knowledge items")
+        
+        if 'text_hash' not in columns:
+            cursor.execute('ALTER TABLE knowledge ADD COLUMN text_hash INTEGER')
+            cursor.execute('SELECT id, text FROM knowledge')
+            updates = [(_text_hash(text), row_id) for row_id, text in cursor.fetchall()]
+            cursor.executemany('UPDATE knowledge SET text_hash = ? WHERE id = ?', updates)
+            logger.info(f"Added text_hash column to {len(updates)} knowledge items")
+        
+        if 'source' not in columns:
+            cursor.execute('ALTER TABLE knowledge ADD COLUMN source TEXT')
+            # Исходная версия дописывала knowledge.json при каждом запуске, не удаляя
+            # старые записи - повторы текстов удаляются, остается первое вхождение
+            cursor.execute('DELETE FROM knowledge WHERE id NOT IN (SELECT MIN(id) FROM knowledge GROUP BY text)')
+            if cursor.rowcount:
+                logger.info(f"Removed {cursor.rowcount} duplicate knowledge items")
+            
+            # Загрузка файла пересобирала базу целиком, поэтому записан не больше чем один
+            # источник - его знания и лежат в таблице; если источники еще не записывались,
+            # знания пришли из knowledge.json по умолчанию
+            cursor.execute('SELECT path FROM knowledge_sources')
+            paths = cursor.fetchall()
+            if len(paths) <= 1:
+                path = paths[0][0] if paths else str(self.knowledge_path.resolve())
+                cursor.execute('UPDATE knowledge SET source = ?', (path,))
+                logger.info(f"Attributed {cursor.rowcount} knowledge items to {path}")
+    
+    def _init_counter(self, cursor: sqlite3.Cursor):
+        """Создать таблицу с числом знаний, которую поддерживают триггеры"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'knowledge_stats'")
+        exists = cursor.fetchone() is not None
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS knowledge_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total_items INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS knowledge_count_insert AFTER INSERT ON knowledge BEGIN
+                UPDATE knowledge_stats SET total_items = total_items + 1 WHERE id = 0;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS knowledge_count_delete AFTER DELETE ON knowledge BEGIN
+                UPDATE knowledge_stats SET total_items = total_items - 1 WHERE id = 0;
+            END
+        ''')
+        
+        if not exists:
+            # Один раз считаются знания, сохраненные до появления счетчика
+            cursor.execute('INSERT INTO knowledge_stats (id, total_items) SELECT 0, COUNT(*) FROM knowledge')
+    
+    def _count_items(self, cursor: sqlite3.Cursor) -> int:
+        """Число знаний в базе за O(1)"""
+        cursor.execute('SELECT total_items FROM knowledge_stats WHERE id = 0')
+        return cursor.fetchone()[0]
+    
+    def _init_fts(self, cursor: sqlite3.Cursor) -> bool:
+        """Создать FTS5 индекс над knowledge; False, если SQLite собрана без FTS5 или trigram"""
+        try:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'knowledge_fts'")
+            exists = cursor.fetchone() is not None
             
-            # Создание таблицы знаний
+            # Индекс хранит только триграммы, тексты читаются из knowledge по rowid
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS knowledge (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    text TEXT NOT NULL,
-                    metadata TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts USING fts5(
+                    text, content='knowledge', content_rowid='id', tokenize='trigram'
                 )
             ''')
             
-            # Создание индекса для полнотекстового поиска
+            # Триггеры поддерживают индекс в актуальном состоянии
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_text ON knowledge(text)
+                CREATE TRIGGER IF NOT EXISTS knowledge_fts_insert AFTER INSERT ON knowledge BEGIN
+                    INSERT INTO knowledge_fts (rowid, text) VALUES (new.id, new.text);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS knowledge_fts_delete AFTER DELETE ON knowledge BEGIN
+                    INSERT INTO knowledge_fts (knowledge_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END
             ''')
             
-            conn.commit()
-            conn.close()
-            
-            logger.info(f"Database initialized at {self.db_path}")
+            if not exists:
+                # Индексирование знаний, сохраненных до появления индекса
+                cursor.execute("INSERT INTO knowledge_fts (knowledge_fts) VALUES ('rebuild')")
+            return True
             
-        except Exception as e:
-            logger.error(f"Error initializing database: {e}")
-            raise
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 trigram index unavailable, large knowledge bases will be scanned: {e}")
+            return False
     
     def add_knowledge(self, texts: List[str], metadata: List[Dict[str, Any]] = None) -> bool:
         """
@@ -75,28 +385,82 @@ class SimpleKnowledgeBase:
                 logger.warning("No texts provided to add_knowledge")
                 return False
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            for i, text in enumerate(texts):
-                meta = metadata[i] if metadata and i < len(metadata) else {}
-                meta_json = json.dumps(meta, ensure_ascii=False)
-                
-                cursor.execute(
-                    'INSERT INTO knowledge (text, metadata) VALUES (?, ?)',
-                    (text, meta_json)
-                )
-            
-            conn.commit()
-            conn.close()
-            
-            logger.info(f"Added {len(texts)} knowledge items to database")
+            self._store_knowledge(texts, metadata)
             return True
             
         except Exception as e:
             logger.error(f"Error adding knowledge: {e}")
             return False
     
+    def _store_knowledge(self, texts: List[str], metadata: Optional[List[Dict[str, Any]]],
+                         source: Optional[str] = None):
+        """Сохранить тексты; если указан источник, его прежние записи заменяются в той же транзакции"""
+        # Повторы текста сохраняются один раз, с метаданными первого вхождения
+        items: Dict[str, Optional[Dict[str, Any]]] = {}
+        for i, text in enumerate(texts):
+            if text not in items:
+                items[text] = metadata[i] if metadata and i < len(metadata) else None
+        
+        with self._transaction() as cursor:
+            removed = 0
+            if source is not None:
+                cursor.execute('DELETE FROM knowledge WHERE source = ?', (source,))
+                removed = cursor.rowcount
+            
+            # Тексты, которые уже есть у этого источника, не добавляются повторно; с другими
+            # источниками тексты не сравниваются, иначе перезагрузка одного файла удалила бы
+            # текст, который нужен другому
+            existing = self._existing_texts(cursor, list(items), source)
+            
+            # Все новые тексты вставляются одним executemany
+            # Текст в нижнем регистре и длина для сортировки сохраняются один раз,
+            # а не вычисляются при каждом поиске; пустые метаданные хранятся как NULL
+            rows = [
+                (text, text.lower(), len(text), _text_hash(text),
+                 json.dumps(meta, ensure_ascii=False) if meta else None, source)
+                for text, meta in items.items() if text not in existing
+            ]
+            cursor.executemany(
+                'INSERT INTO knowledge (text, text_lower, text_len, text_hash, metadata, source) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows
+            )
+        
+        if removed:
+            # Позиции снимка больше не соответствуют строкам, снимок строится заново
+            self._invalidate_snapshot()
+        elif rows and self._snapshot is not None:
+            # Загруженный снимок дополняется новыми строками вместо полной пересборки
+            if len(self._snapshot[1]) + len(rows) <= IN_MEMORY_SEARCH_LIMIT:
+                with self._cursor() as cursor:
+                    self._extend_snapshot(cursor)
+            else:
+                self._invalidate_snapshot()
+        if rows or removed:
+            self._invalidate_search_cache()
+        
+        logger.info(f"Added {len(rows)} knowledge items to database, "
+                    f"skipped {len(texts) - len(rows)} duplicates"
+                    + (f", replaced {removed} items from {source}" if removed else ""))
+    
+    def _existing_texts(self, cursor: sqlite3.Cursor, texts: List[str], source: Optional[str]) -> set:
+        """Тексты из списка, которые уже сохранены в базе с указанным источником
+        
+        Кандидаты ищутся по индексу хешей; при совпадении хешей разных текстов
+        лишний текст просто не встретится среди добавляемых
+        """
+        existing = set()
+        for start in range(0, len(texts), DUPLICATE_CHECK_CHUNK):
+            chunk = [_text_hash(text) for text in texts[start:start + DUPLICATE_CHECK_CHUNK]]
+            cursor.execute(
+                # Унарный плюс не дает планировщику выбрать idx_source: у большого файла
+                # это просмотр всех его строк вместо нескольких строк по хешу
+                f'SELECT text FROM knowledge WHERE text_hash IN ({",".join("?" * len(chunk))}) '
+                'AND +source IS ?',
+                chunk + [source]
+            )
+            existing.update(text for text, in cursor)
+        return existing
+    
     def search(self, query: str, top_k: int = 3) -> List[Tuple[str, float, Dict[str, Any]]]:
         """
         Поиск релевантных знаний по запросу
@@ -109,60 +473,273 @@ class SimpleKnowledgeBase:
             Список кортежей: (текст, оценка, метаданные)
         """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Простой поиск по ключевым словам
-            query_words = re.findall(r'\w+', query.lower())
+            query_words = _query_words(query)
             
             if not query_words:
-                conn.close()
                 return []
             
-            # Поиск по ключевым словам
-            search_conditions = []
-            params = []
-            
-            for word in query_words:
-                search_conditions.append("LOWER(text) LIKE ?")
-                params.append(f"%{word}%")
-            
-            sql = f'''
-                SELECT text, metadata, 
-                       ({" + ".join([f"CASE WHEN LOWER(text) LIKE ? THEN 1 ELSE 0 END" for _ in query_words])}) as score
-                FROM knowledge 
-                WHERE {" OR ".join(search_conditions)}
-                ORDER BY score DESC, LENGTH(text) ASC
-                LIMIT ?
-            '''
-            
-            # Добавляем параметры для подсчета очков
-            params.extend([f"%{word}%" for word in query_words])
-            params.append(top_k)
-            
-            cursor.execute(sql, params)
-            results = cursor.fetchall()
-            conn.close()
-            
-            # Форматирование результатов
-            formatted_results = []
-            for text, meta_json, score in results:
-                try:
-                    metadata = json.loads(meta_json) if meta_json else {}
-                except:
-                    metadata = {}
-                
-                # Нормализация оценки (0-1)
-                normalized_score = min(score / len(query_words), 1.0)
-                formatted_results.append((text, normalized_score, metadata))
+            # Повторный запрос с теми же словами отдается из кеша без обращения к базе
+            cache_key = (tuple(query_words), top_k)
+            with self._search_cache_lock:
+                cached = self._search_cache.get(cache_key)
+                if cached is not None:
+                    self._search_cache.move_to_end(cache_key)
+                    return list(cached)
+                generation = self._search_cache_generation
+            
+            snapshot = self._get_snapshot()
+            if snapshot is not None:
+                best = self._rank_snapshot(snapshot, query_words, top_k)
+                rows = self._fetch_rows([row_id for _, _, row_id in best])
+                results = [(*rows[row_id], -neg_score) for neg_score, _, row_id in best if row_id in rows]
+            else:
+                # Строки читаются из курсора прямо при форматировании, без промежуточного списка
+                results = self._search_sql(query_words, top_k)
+            
+            formatted_results = self._format_results(results, len(query_words))
+            
+            with self._search_cache_lock:
+                if generation == self._search_cache_generation:
+                    self._search_cache[cache_key] = formatted_results
+                    if len(self._search_cache) > SEARCH_CACHE_SIZE:
+                        self._search_cache.popitem(last=False)
             
             logger.debug(f"Search query '{query}' returned {len(formatted_results)} results")
-            return formatted_results
+            return list(formatted_results)
             
         except Exception as e:
             logger.error(f"Error searching knowledge: {e}")
             return []
     
+    def search_many(self, queries: List[str], top_k: int = 3) -> List[List[Tuple[str, float, Dict[str, Any]]]]:
+        """
+        Поиск по нескольким запросам за один проход
+        
+        Args:
+            queries: Список поисковых запросов
+            top_k: Количество лучших результатов для каждого запроса
+            
+        Returns:
+            Список результатов в порядке запросов
+        """
+        try:
+            snapshot = self._get_snapshot()
+            if snapshot is None:
+                return [self.search(query, top_k) for query in queries]
+            
+            # Ранжирование по снимку, затем одно чтение текстов для всех запросов
+            ranked = []
+            for query in queries:
+                query_words = _query_words(query)
+                best = self._rank_snapshot(snapshot, query_words, top_k) if query_words else []
+                ranked.append((query_words, best))
+            
+            rows = self._fetch_rows(list({row_id for _, best in ranked for _, _, row_id in best}))
+            
+            return [
+                self._format_results(
+                    [(*rows[row_id], -neg_score) for neg_score, _, row_id in best if row_id in rows],
+                    len(query_words)
+                )
+                for query_words, best in ranked
+            ]
+            
+        except Exception as e:
+            logger.error(f"Error searching knowledge: {e}")
+            return [[] for _ in queries]
+    
+    def _format_results(self, results: Iterable[Tuple[str, str, int]], 
+                        words_count: int) -> List[Tuple[str, float, Dict[str, Any]]]:
+        """Форматирование результатов: разбор метаданных и нормализация оценки (0-1)"""
+        return [
+            (text, min(score / words_count, 1.0), self._parse_metadata(meta_json))
+            for text, meta_json, score in results
+        ]
+    
+    def _parse_metadata(self, meta_json: Optional[str]) -> Dict[str, Any]:
+        """Разбор метаданных; пустые и поврежденные метаданные дают пустой словарь"""
+        if not meta_json or meta_json == EMPTY_META_JSON:
+            return {}
+        try:
+            return orjson.loads(meta_json) if orjson is not None else json.loads(meta_json)
+        except ValueError:
+            return {}
+    
+    def _rank_snapshot(self, snapshot: Snapshot, query_words: List[str], 
+                       top_k: int) -> List[Tuple[int, int, int]]:
+        """Ранжирование по снимку в памяти так же, как в SQL запросе: (-оценка, длина, id)"""
+        # Считаются только тексты из словаря токенов, а не весь снимок
+        lengths, row_ids = snapshot[0], snapshot[1]
+        scores: Dict[int, int] = {}
+        matches: Dict[str, set] = {}
+        for word in query_words:
+            if word not in matches:
+                matches[word] = self._match_positions(snapshot, word)
+            for position in matches[word]:
+                scores[position] = scores.get(position, 0) + 1
+        
+        scored = ((-score, lengths[position], row_ids[position]) for position, score in scores.items())
+        return heapq.nsmallest(top_k, scored)
+    
+    def _match_positions(self, snapshot: Snapshot, word: str) -> set:
+        """Позиции текстов снимка, содержащих слово как подстроку
+        
+        В слове нет разделителей, поэтому любое его вхождение в текст лежит
+        внутри одного токена - достаточно проверить словарь, а не все тексты.
+        Токены-кандидаты берутся из индекса n-грамм, а не перебором словаря
+        """
+        _, _, postings, vocabulary, grams = snapshot
+        n = VOCABULARY_GRAM_LENGTH
+        if len(word) <= n:
+            candidates = grams.get(word, ())
+        else:
+            # Подстрока содержит каждую свою триграмму: достаточно проверить токены самой редкой
+            candidates = min(
+                (grams.get(word[i:i + n], ()) for i in range(len(word) - n + 1)), key=len
+            )
+        
+        positions = set()
+        for index in candidates:
+            token = vocabulary[index]
+            if word in token:
+                positions.update(postings[token])
+        return positions
+    
+    def _fetch_rows(self, row_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """Прочитать текст и метаданные по id (снимок хранит только текст для сравнения)"""
+        if not row_ids:
+            return {}
+        
+        cursor = self._conn().execute(
+            f'SELECT id, text, metadata FROM knowledge WHERE id IN ({",".join("?" * len(row_ids))})',
+            row_ids
+        )
+        return {row_id: (text, meta_json) for row_id, text, meta_json in cursor}
+    
+    def _search_sql(self, query_words: List[str], top_k: int) -> Iterator[Tuple[str, str, int]]:
+        """Поиск по ключевым словам средствами SQLite для больших баз знаний"""
+        if len(query_words) == 1:
+            return self._search_single(query_words[0], top_k)
+        if self._fts_enabled and min(len(word) for word in query_words) >= FTS_MIN_WORD_LENGTH:
+            return self._search_fts(query_words, top_k)
+        return self._search_scan(query_words, top_k)
+    
+    def _search_single(self, word: str, top_k: int) -> Iterator[Tuple[str, str, int]]:
+        """Поиск по одному слову: оценка всегда 1, нужен только порядок по длине текста"""
+        if self._fts_enabled and len(word) >= FTS_MIN_WORD_LENGTH:
+            sql, param = SINGLE_WORD_FTS_SQL, f'"{word}"'
+        else:
+            sql, param = SINGLE_WORD_SCAN_SQL, word
+        
+        # Запросы из одной инструкции выполняются прямо через соединение, без явного курсора
+        yield from self._conn().execute(sql, (param, top_k))
+    
+    def _search_fts(self, query_words: List[str], top_k: int) -> Iterator[Tuple[str, str, int]]:
+        """Поиск через триграммный индекс: читаются только тексты, содержащие хотя бы одно слово"""
+        # Каждое слово - фраза FTS5, то есть поиск подстроки без учета регистра
+        phrases = [f'"{word}"' for word in query_words]
+        
+        yield from self._conn().execute(_fts_sql(len(phrases)), [*phrases, " OR ".join(phrases), top_k])
+    
+    def _search_scan(self, query_words: List[str], top_k: int) -> Iterator[Tuple[str, str, int]]:
+        """Поиск полным просмотром таблицы, если индекс недоступен или слово короче триграммы"""
+        # Поиск по ключевым словам: INSTR проверяет вхождение подстроки без разбора шаблона LIKE,
+        # text_lower избавляет от LOWER() на каждой строке; длинные слова встречаются реже,
+        # поэтому идут первыми
+        words = sorted(query_words, key=len, reverse=True)
+        
+        yield from self._conn().execute(_scan_sql(len(words)), [*words, top_k])
+    
+    def _get_snapshot(self) -> Optional[Snapshot]:
+        """Снимок базы знаний в памяти или None, если база слишком велика"""
+        if not self._snapshot_loaded:
+            with self._cursor() as cursor:
+                if self._count_items(cursor) <= IN_MEMORY_SEARCH_LIMIT:
+                    cursor.execute('SELECT id, text FROM knowledge ORDER BY id')
+                    self._snapshot = self._build_snapshot(cursor)
+                else:
+                    self._snapshot = None
+            self._snapshot_loaded = True
+        
+        return self._snapshot
+    
+    def _build_snapshot(self, rows, base: Optional[Snapshot] = None) -> Snapshot:
+        """Построить снимок по строкам (id, текст), продолжая base, если он задан
+        
+        base не изменяется: массивы копируются, а в словаре токенов копируются
+        только списки позиций токенов, встреченных в новых строках
+        """
+        if base is None:
+            lengths, row_ids, postings, vocabulary, grams = array('I'), array('q'), {}, [], {}
+        else:
+            lengths, row_ids = array('I', base[0]), array('q', base[1])
+            postings, vocabulary, grams = dict(base[2]), list(base[3]), dict(base[4])
+        
+        # Списки base, которые уже скопированы и могут дополняться
+        copied, copied_grams = set(), set()
+        for position, (row_id, text) in enumerate(rows, len(row_ids)):
+            lengths.append(len(text))
+            row_ids.append(row_id)
+            for token in set(WORD_RE.findall(text.lower())):
+                if token not in copied:
+                    token_positions = postings.get(token)
+                    if token_positions is None:
+                        postings[token] = array('I')
+                        self._index_token(grams, copied_grams, token, len(vocabulary))
+                        vocabulary.append(token)
+                    else:
+                        postings[token] = array('I', token_positions)
+                    copied.add(token)
+                postings[token].append(position)
+        return lengths, row_ids, postings, vocabulary, grams
+    
+    def _index_token(self, grams: Dict[str, array], copied_grams: set, token: str, index: int):
+        """Добавить номер нового токена в списки всех его n-грамм длиной до VOCABULARY_GRAM_LENGTH"""
+        token_grams = {
+            token[i:i + n]
+            for n in range(1, VOCABULARY_GRAM_LENGTH + 1)
+            for i in range(len(token) - n + 1)
+        }
+        for gram in token_grams:
+            if gram not in copied_grams:
+                gram_tokens = grams.get(gram)
+                grams[gram] = array('I') if gram_tokens is None else array('I', gram_tokens)
+                copied_grams.add(gram)
+            grams[gram].append(index)
+    
+    def _extend_snapshot(self, cursor: sqlite3.Cursor):
+        """Заменить снимок копией, дополненной строками после последнего id снимка"""
+        snapshot = self._snapshot
+        row_ids = snapshot[1]
+        cursor.execute(
+            'SELECT id, text FROM knowledge WHERE id > ? ORDER BY id',
+            (row_ids[-1] if row_ids else 0,)
+        )
+        self._snapshot = self._build_snapshot(cursor, snapshot)
+    
+    def _snapshot_size(self, snapshot: Optional[Snapshot]) -> int:
+        """Примерный объем снимка в памяти в байтах"""
+        if not snapshot:
+            return 0
+        lengths, row_ids, postings, vocabulary, grams = snapshot
+        return sys.getsizeof(lengths) + sys.getsizeof(row_ids) + sys.getsizeof(postings) + sum(
+            sys.getsizeof(token) + sys.getsizeof(positions) for token, positions in postings.items()
+        ) + sys.getsizeof(vocabulary) + sys.getsizeof(grams) + sum(
+            sys.getsizeof(gram) + sys.getsizeof(tokens) for gram, tokens in grams.items()
+        )
+    
+    def _invalidate_search_cache(self):
+        """Сбросить кеш результатов поиска после изменения базы знаний"""
+        with self._search_cache_lock:
+            self._search_cache.clear()
+            self._search_cache_generation += 1
+    
+    def _invalidate_snapshot(self):
+        """Сбросить снимок после изменения базы знаний"""
+        self._snapshot = None
+        self._snapshot_loaded = False
+    
     def load_knowledge_from_json(self, json_path: str = None) -> bool:
         """
         Загрузить знания из JSON файла
@@ -182,57 +759,85 @@ class SimpleKnowledgeBase:
                 logger.warning(f"Knowledge JSON file not found: {json_path}")
                 return False
             
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            source_key = str(json_path.resolve())
+            if source_key in self._loaded_paths:
+                return True
+            
+            raw = json_path.read_bytes()
+            content_hash = hashlib.sha256(raw).hexdigest()
             
+            if self._get_source_hash(source_key) == content_hash:
+                self._loaded_paths.add(source_key)
+                logger.info(f"Knowledge from {json_path} is up to date, skipping load")
+                return True
+            
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+            
+            # Фильтрация пустых текстов при разборе
             if isinstance(data, list):
-                # Список строк
-                texts = data
-                metadata = [{}] * len(texts)
+                # Список строк, метаданных нет
+                texts = [text for text in data if text.strip()]
+                metadata = None
             elif isinstance(data, dict) and 'knowledge' in data:
                 # Структурированный формат
-                knowledge_items = data['knowledge']
-                texts = [item.get('text', '') for item in knowledge_items]
-                metadata = [item.get('metadata', {}) for item in knowledge_items]
+                valid_items = [item for item in data['knowledge'] if item.get('text', '').strip()]
+                texts = [item['text'] for item in valid_items]
+                metadata = [item.get('metadata', {}) for item in valid_items]
             else:
                 logger.error("Invalid JSON format for knowledge")
                 return False
             
-            # Фильтрация пустых текстов
-            valid_items = [(text, meta) for text, meta in zip(texts, metadata) if text.strip()]
-            if not valid_items:
+            if not texts:
                 logger.warning("No valid knowledge items found in JSON")
                 return False
             
-            texts, metadata = zip(*valid_items)
-            
-            # Добавление в базу данных
-            success = self.add_knowledge(list(texts), list(metadata))
+            # JSON файл - источник истины для своих записей: они заменяются целиком,
+            # знания из других файлов и добавленные через add_knowledge сохраняются
+            self._store_knowledge(texts, metadata, source=source_key)
             
-            if success:
-                logger.info(f"Loaded {len(texts)} knowledge items from {json_path}")
-            
-            return success
+            self._set_source_hash(source_key, content_hash)
+            self._loaded_paths.add(source_key)
+            logger.info(f"Loaded {len(texts)} knowledge items from {json_path}")
+            return True
             
         except Exception as e:
             logger.error(f"Error loading knowledge from JSON: {e}")
             return False
     
+    def _get_source_hash(self, source_key: str) -> Optional[str]:
+        """Хеш содержимого JSON файла при последней загрузке"""
+        row = self._conn().execute(
+            'SELECT content_hash FROM knowledge_sources WHERE path = ?',
+            (source_key,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def _set_source_hash(self, source_key: str, content_hash: str):
+        """Запомнить хеш загруженного JSON файла"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO knowledge_sources (path, content_hash) VALUES (?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET content_hash = excluded.content_hash, '
+                'loaded_at = CURRENT_TIMESTAMP',
+                (source_key, content_hash)
+            )
+    
     def get_stats(self) -> Dict[str, Any]:
         """Получить статистику базы знаний"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT COUNT(*) FROM knowledge')
-            total_items = cursor.fetchone()[0]
-            
-            conn.close()
+            with self._cursor() as cursor:
+                total_items = self._count_items(cursor)
             
+            # Снимок читается один раз: его может заменить запись из другого потока
+            snapshot = self._snapshot
             return {
                 'total_items': total_items,
                 'model_name': 'Simple Text Search',
-                'db_path': str(self.db_path),
+                'snapshot_items': len(snapshot[1]) if snapshot else 0,
+                'snapshot_bytes': self._snapshot_size(snapshot),
+                'snapshot_terms': len(snapshot[2]) if snapshot else 0,
+                'search_cache_size': len(self._search_cache),
+                'db_path': self._db_str,
                 'knowledge_path': str(self.knowledge_path)
             }
             
@@ -241,19 +846,19 @@ class SimpleKnowledgeBase:
             return {
                 'total_items': 0,
                 'model_name': 'Simple Text Search',
-                'db_path': str(self.db_path),
+                'db_path': self._db_str,
                 'knowledge_path': str(self.knowledge_path)
             }
     
     def clear(self) -> bool:
         """Очистить всю базу знаний"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM knowledge')
-            conn.commit()
-            conn.close()
+            with self._transaction() as cursor:
+                cursor.execute('DELETE FROM knowledge')
+                cursor.execute('DELETE FROM knowledge_sources')
+            self._invalidate_snapshot()
+            self._invalidate_search_cache()
+            self._loaded_paths.clear()
             
             logger.info("Cleared knowledge database")
             return True
@@ -261,32 +866,71 @@ class SimpleKnowledgeBase:
         except Exception as e:
             logger.error(f"Error clearing database: {e}")
             return False
+    
+    def close(self):
+        """Перенести WAL в файл базы и закрыть соединения всех потоков"""
+        with self._connections_lock:
+            if self._connections:
+                try:
+                    self._connections[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    logger.error(f"WAL checkpoint error: {e}")
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+# Глобальный экземпляр базы знаний, создается при первом обращении
+_knowledge_db: Optional[SimpleKnowledgeBase] = None
+
+
+def get_knowledge_db() -> SimpleKnowledgeBase:
+    """Глобальная база знаний; открывается при первом вызове, а не при импорте модуля"""
+    global _knowledge_db
+    if _knowledge_db is None:
+        _knowledge_db = SimpleKnowledgeBase()
+    return _knowledge_db
 
 
-# Глобальный экземпляр базы знаний
-knowledge_db = SimpleKnowledgeBase()
+def __getattr__(name: str):
+    # `vector_db.knowledge_db` продолжает работать без создания базы при импорте
+    if name == 'knowledge_db':
+        return get_knowledge_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def add_knowledge(texts: List[str], metadata: List[Dict[str, Any]] = None) -> bool:
     """Удобная функция для добавления знаний"""
-    return knowledge_db.add_knowledge(texts, metadata)
+    return get_knowledge_db().add_knowledge(texts, metadata)
 
 
 def search_knowledge(query: str, top_k: int = 3) -> List[Tuple[str, float, Dict[str, Any]]]:
     """Удобная функция для поиска знаний"""
-    return knowledge_db.search(query, top_k)
+    return get_knowledge_db().search(query, top_k)
+
+
+def search_knowledge_batch(queries: List[str], top_k: int = 3) -> List[List[Tuple[str, float, Dict[str, Any]]]]:
+    """Удобная функция для поиска по нескольким запросам"""
+    return get_knowledge_db().search_many(queries, top_k)
 
 
 def load_knowledge_from_json(json_path: str = None) -> bool:
     """Удобная функция для загрузки знаний из JSON"""
-    return knowledge_db.load_knowledge_from_json(json_path)
+    return get_knowledge_db().load_knowledge_from_json(json_path)
 
 
 def get_vector_db_stats() -> Dict[str, Any]:
     """Удобная функция для получения статистики базы знаний"""
-    return knowledge_db.get_stats()
+    return get_knowledge_db().get_stats()
 
 
 def save_vector_db() -> bool:
     """Удобная функция для сохранения базы знаний (не нужно для SQLite)"""
     return True
+
+
+def close_vector_db():
+    """Удобная функция для закрытия соединений базы знаний"""
+    if _knowledge_db is not None:
+        _knowledge_db.close()